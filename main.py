@@ -24,7 +24,7 @@ def base_HSD_Test(graphName, hop=3, metric="wasserstein"):
     score_max, scale_opt = 0, 0
     for scale in np.linspace(scale_min, scale_max, num=5, dtype=np.float):
         model.scale = scale
-        model.calculate_wavelets(model.scale, approx=True)
+        model.wavelets = model.calculate_wavelets(model.scale, approx=True)
         dists = model.parallel_calculate_HSD(n_workers=10)
         knn_score = evaluate.KNN_evaluate(dists, labels, metric="precomputed", cv=10, n_neighbor=20)
         if knn_score > score_max:
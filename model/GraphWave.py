@@ -2,77 +2,152 @@
 
 import networkx as nx
 import numpy as np
-import pygsp
+from scipy import sparse
 from tqdm import tqdm
-from tools import util
+from tools import scratch
+from tools import wavelets as wavelet_backend
+from tools.graph_operator import GraphOperator
+from tools.spectral_cache import cached_eigh
 
 
 class GraphWave(object):
 
-    def __init__(self, graph:nx.Graph):
+    def __init__(self, graph:nx.Graph, block_size=256, sparse_wavelets=False, dtype=np.float64,
+                 chebyshev_tol=None, chebyshev_damping=None, operator=None, scratch_dir=None,
+                 working_set_bytes=1 << 28):
         """
         Hierarchicall Structural Distance model.
         :param graph: nx.Graph
+        :param block_size: number of impulses per chebyshev recurrence in 'block' mode
+        :param sparse_wavelets: if True, wavelets are thresholded into CSR matrices
+        :param dtype: float type of laplacian, wavelets and embeddings
+        :param chebyshev_tol: target error of chebyshev wavelets, the order is chosen per scale,
+                              defaults to a tenth of the wavelet threshold
+        :param chebyshev_damping: None, 'jackson' or 'lanczos'
+        :param operator: GraphOperator of graph, pass the same one to several models to share the setup
+        :param scratch_dir: if set, dense wavelets are np.memmap files in this directory,
+                            and the eigen decomposition is only done if the exact wavelets are asked for
+        :param working_set_bytes: with scratch_dir, row blocks are sized to keep memory within this budget
         """
         self.graph = graph
-        self.adjacent = nx.adjacency_matrix(graph).todense()
-        self.laplacian = nx.laplacian_matrix(graph).todense()
-        self.nodes = list(nx.nodes(graph))
-
-        self.idx2node, self.node2idx = util.build_node_idx_map(graph)
-        self.eigenvalues, self.eigenvectors = np.linalg.eigh(self.laplacian)
+        self.dtype = np.dtype(dtype)
+        self.operator = operator if operator is not None else GraphOperator(graph, self.dtype)
+        self.sparse_laplacian = self.operator.laplacian.astype(self.dtype, copy=False)
+        self.block_size = block_size
+        self.sparse_wavelets = sparse_wavelets
+        self.chebyshev_tol = chebyshev_tol
+        self.chebyshev_damping = chebyshev_damping
+        self.chebyshev = wavelet_backend.ChebyshevSeries(
+            self.operator.get_lmax, chebyshev_tol if chebyshev_tol is not None else 1e-6 * 1.0 / self.operator.n_node,
+            chebyshev_damping)
+        # orders and error bounds of each scale, filled by get_chebyshev_coeffs
+        self.chebyshev_orders, self.chebyshev_errors = self.chebyshev.orders, self.chebyshev.errors
+        self.chebyshev_damping_losses = self.chebyshev.damping_losses
+        self.scratch_dir = scratch_dir
+        self.working_set_bytes = working_set_bytes
+        self.nodes = self.operator.nodes
+
+        self.idx2node, self.node2idx = self.operator.idx2node, self.operator.node2idx
+        self.eigenvalues, self.eigenvectors = None, None
+        if scratch_dir is None:
+            self.eigenvalues, self.eigenvectors = cached_eigh(self.sparse_laplacian, self.nodes)
         self.wavelets = None
 
 
-    # caculate wavelet coefficients
-    # approx: if True then use chebshev polynomials
-    def calculate_wavelets(self, scale, approx=True) -> np.ndarray:
-        if approx:
-            G = pygsp.graphs.Graph(self.adjacent)
-            G.estimate_lmax()
-            heat_filter = pygsp.filters.Heat(G, tau=[scale * G._lmax])
-            chebyshev = pygsp.filters.approximations.compute_cheby_coeff(heat_filter, m=40)
-            wavelets = []
-            for idx in range(len(self.nodes)):
-                impulse = np.zeros(len(self.nodes), dtype=np.float)
-                impulse[idx] = 1.0
-                coeff = pygsp.filters.approximations.cheby_op(G, chebyshev, impulse)
-                wavelets.append(coeff)
-        else:
-            assert getattr(self, "eigenvalues", None) is not None, "GraphWave eigenvalues is None!"
-            wavelets = np.dot(np.dot(self.eigenvectors, np.diag(np.exp(-1 * scale * self.eigenvalues))),
-                                 np.transpose(self.eigenvectors))
+    # dense adjacency matrix, only built when asked for
+    @property
+    def adjacent(self) -> np.ndarray:
+        return self.operator.adjacency.todense().astype(self.dtype)
+
+
+    # dense laplacian matrix, only built when asked for
+    @property
+    def laplacian(self) -> np.ndarray:
+        return self.sparse_laplacian.todense()
+
 
-        threshold = np.vectorize(lambda x: x if x > 1e-5 * 1.0 / len(self.nodes) else 0)
-        processed_wavelets = threshold(wavelets)
+    # chebyshev coefficients of heat kernel at scale, with the lowest order meeting self.chebyshev_tol.
+    # the order is chosen by the truncation error alone, the order and the error bound of the damped series
+    # of each scale are kept in self.chebyshev_orders and self.chebyshev_errors,
+    # the damping part of the bound in self.chebyshev_damping_losses
+    def get_chebyshev_coeffs(self, scale) -> np.ndarray:
+        return self.chebyshev.get(scale)
+
+
+    # caculate wavelet coefficients
+    # approx: if True then use chebshev polynomials, 'block' runs them on blocks of impulses,
+    #         'expm' uses krylov expm_multiply on blocks of impulses
+    # returns a CSR matrix if self.sparse_wavelets, else a dense one (a memmap if self.scratch_dir is set).
+    def calculate_wavelets(self, scale, approx=True):
+        n = len(self.nodes)
+        block_size, out = self.block_size, None
+        if self.scratch_dir is not None:
+            # a chebyshev block keeps about 5 dense buffers alive
+            block_size = min(block_size, scratch.rows_per_block(n, self.dtype, self.working_set_bytes, 5))
+            if not self.sparse_wavelets:
+                out = scratch.memmap_array((n, n), self.dtype, self.scratch_dir)
+        processed_wavelets = wavelet_backend.assemble_wavelets(
+            lambda rows: self.calculate_wavelet_rows(scale, approx, rows), n, block_size,
+            1e-5 * 1.0 / n, sparse_output=self.sparse_wavelets, dtype=self.dtype, out=out)
         self.wavelets = processed_wavelets
         return processed_wavelets
 
 
+    # wavelet coefficients of the given rows (node indices), before thresholding
+    def calculate_wavelet_rows(self, scale, approx, rows) -> np.ndarray:
+        if approx == "expm":
+            return wavelet_backend.expm_rows(self.sparse_laplacian, scale, rows, self.dtype)
+        elif approx == "block":
+            return wavelet_backend.chebyshev_op(self.sparse_laplacian, self.get_chebyshev_coeffs(scale),
+                                                self.operator.get_lmax(),
+                                                wavelet_backend.impulses(len(self.nodes), rows, self.dtype)).T
+        elif approx:
+            return self.operator.pygsp_heat_rows(scale, self.chebyshev.order(scale), self.chebyshev_damping, rows,
+                                                 self.dtype)
+        else:
+            if self.eigenvalues is None or self.eigenvectors is None:
+                self.eigenvalues, self.eigenvectors = cached_eigh(self.sparse_laplacian, self.nodes)
+            return wavelet_backend.heat_kernel_rows(self.eigenvalues, self.eigenvectors, scale, rows, self.dtype)
+
+
     # 计算特征函数的采样值
-    def calculate_characteristic_value(self, X: np.ndarray, sample_points):
+    # n_zeros: number of zero coefficients not listed in X, as in the rows of sparse wavelets
+    def calculate_characteristic_value(self, X: np.ndarray, sample_points, n_zeros=0):
+        X = np.asarray(X).reshape(-1)
         embedding = []
         for _, t in enumerate(sample_points):
-            value = np.mean(np.exp(1j * X * t))
+            value = (np.sum(np.exp(1j * X * t)) + n_zeros) / (len(X) + n_zeros)
             embedding.append(value.real)
             embedding.append(value.imag)
-        return np.array(embedding, dtype=np.float)
+        return np.array(embedding, dtype=self.dtype)
 
 
     def embed(self, sample_points):
         assert self.wavelets is not None, "GraphWave wavelets is None!"
         embedding_dict = dict()
+        n = len(self.nodes)
         for idx, node in tqdm(enumerate(self.nodes)):
-            wavelet_coeffs = self.wavelets[idx, :]
-            embedding_vector = self.calculate_characteristic_value(wavelet_coeffs, sample_points)
+            if sparse.issparse(self.wavelets):
+                start, end = self.wavelets.indptr[idx], self.wavelets.indptr[idx + 1]
+                wavelet_coeffs = self.wavelets.data[start:end]
+                n_zeros = n - (end - start)
+            else:
+                wavelet_coeffs, n_zeros = self.wavelets[idx, :], 0
+            embedding_vector = self.calculate_characteristic_value(wavelet_coeffs, sample_points, n_zeros)
             embedding_dict[node] = embedding_vector
         return embedding_dict
 
 
 # 根据特征值计算尺度选取范围
-def recommend_scale_range(eignvalues: list) -> (float, float):
+def recommend_scale_range(eignvalues: list, lmax=None) -> (float, float):
+    """
+    :param eignvalues: full spectrum, or the smallest part of it (see HSD.get_partial_spectrum)
+    :param lmax: largest eigenvalue, needed when eignvalues is a partial spectrum
+    """
     eignvalues = sorted(eignvalues)
     e1, en = eignvalues[0], eignvalues[-1]
+    if lmax is not None:
+        en = lmax
     for e in eignvalues:
         if e > 0.001:
             e1 = e
@@ -2,21 +2,34 @@
 
 # Hierarchically Structural Distance model
 
-import multiprocessing
+import functools
+import weakref
 
-import networkx as nx
 import numpy as np
 import pygsp
+from scipy.spatial.distance import cdist
 from scipy.stats import wasserstein_distance
 from tqdm import tqdm
 
+from tools import checkpoint
+from tools import condensed
+from tools import knn
 from tools import metrics
+from tools import parallel
+from tools import scratch
 from tools import read_hierarchical_representation
-from tools import util
+from tools import rw
+from tools import wavelets as wavelet_backend
+from tools.graph_operator import GraphOperator
+from tools.hierarchy import hierarchy_to_rings
+from tools.spectral_cache import cached_eigh, cached_eigsh, laplacian_hash
 
 class HSD(object):
 
-    def __init__(self, graph, graphName, scale, hop, metric):
+    def __init__(self, graph, graphName, scale, hop, metric, block_size=256, n_eigenpairs=128,
+                 sparse_wavelets=False, wavelet_cache_bytes=None, dtype=np.float64,
+                 chebyshev_tol=None, chebyshev_damping=None, operator=None, scratch_dir=None,
+                 working_set_bytes=1 << 28, condensed_distance=False, distance_dtype=None):
         """
         Hierarchicall Structural Distance model.
         :param graph: nx.Graph
@@ -24,47 +37,189 @@ class HSD(object):
         :param scale: the heat coefficient
         :param metric: 'Wasserstein' or 'Hellinger'
         :param hop: k-hop local neighborhoods
+        :param block_size: number of impulses per chebyshev recurrence in 'block' mode
+        :param n_eigenpairs: size of the partial spectrum in 'lanczos' mode
+        :param sparse_wavelets: if True, wavelets are thresholded into CSR matrices
+        :param wavelet_cache_bytes: if set, wavelets are lazy WaveletRows whose cached blocks stay within this budget,
+                                    'lanczos' wavelets are always lazy, within working_set_bytes by default
+        :param dtype: float type of laplacian, wavelets and distances, np.float32 halves memory and bandwidth
+        :param chebyshev_tol: target error of chebyshev wavelets, the order is chosen per scale,
+                              defaults to a tenth of the wavelet threshold
+        :param chebyshev_damping: None, 'jackson' or 'lanczos'
+        :param operator: GraphOperator of graph, pass the same one to several models to share the setup
+        :param scratch_dir: if set, dense wavelets and distance matrices are np.memmap files in this directory
+        :param working_set_bytes: with scratch_dir, row blocks are sized to keep memory within this budget
+        :param condensed_distance: if True, distances are the 1-D upper triangle in squareform layout (see tools.condensed)
+        :param distance_dtype: float type of distances, e.g. np.float32 or np.float16, defaults to dtype
         """
         self.graph = graph
         self.graphName = graphName
         self.scale = scale
         self.hop = hop
         self.metric = metric
-        self.A = nx.adjacency_matrix(graph).todense()
-        self.L = nx.laplacian_matrix(graph).todense()
+        self.dtype = np.dtype(dtype)
+        self.operator = operator if operator is not None else GraphOperator(graph, self.dtype)
+        self.sparse_L = self.operator.laplacian.astype(self.dtype, copy=False)
         #self.L = nx.normalized_laplacian_matrix(graph).todense()
 
-        self.nodes = list(nx.nodes(graph))
-        self.n_node = len(self.nodes)
-        self.idx2node, self.node2idx = util.build_node_idx_map(graph)
+        self.nodes = self.operator.nodes
+        self.n_node = self.operator.n_node
+        self.idx2node, self.node2idx = self.operator.idx2node, self.operator.node2idx
         self.hierarchy = None
+        self.block_size = block_size
+        self.eigenvalues, self.eigenvectors = None, None
+        self.n_eigenpairs = n_eigenpairs
+        self.truncation_errors = dict()
+        self.sparse_wavelets = sparse_wavelets
+        self.wavelet_cache_bytes = wavelet_cache_bytes
+        self.chebyshev_tol = chebyshev_tol
+        self.chebyshev_damping = chebyshev_damping
+        self.chebyshev = wavelet_backend.ChebyshevSeries(
+            self.operator.get_lmax, chebyshev_tol if chebyshev_tol is not None else 1e-5 * 1.0 / self.n_node,
+            chebyshev_damping)
+        # orders and error bounds of each scale, filled by get_chebyshev_coeffs
+        self.chebyshev_orders, self.chebyshev_errors = self.chebyshev.orders, self.chebyshev.errors
+        self.chebyshev_damping_losses = self.chebyshev.damping_losses
+        self.scratch_dir = scratch_dir
+        self.working_set_bytes = working_set_bytes
+        self.condensed_distance = condensed_distance
+        self.distance_dtype = np.dtype(distance_dtype) if distance_dtype is not None else self.dtype
+        self.wavelets = None
+        self.profile_values, self.profile_offsets = None, None
+        self.profile_source = None
+        self.pruning_stats = None
+        self.quantile_errors = None
+        self.parallel_stats = None
 
     # init HSD model
     def init(self):
         self.hierarchy = read_hierarchical_representation(self.graphName, self.hop)
 
+    # dense adjacency matrix, only built when asked for
+    @property
+    def A(self) -> np.ndarray:
+        return self.operator.adjacency.todense().astype(self.dtype)
+
+    # dense laplacian matrix, only built when asked for
+    @property
+    def L(self) -> np.ndarray:
+        return self.sparse_L.todense()
+
+    # largest eigenvalue of laplacian, estimated once per graph operator
+    def get_lmax(self) -> float:
+        return self.operator.get_lmax()
+
+    # eigen decomposition of laplacian, shared by all scales and served from the spectral cache
+    def get_spectrum(self) -> (np.ndarray, np.ndarray):
+        if self.eigenvalues is None or self.eigenvectors is None:
+            self.eigenvalues, self.eigenvectors = cached_eigh(self.sparse_L, self.nodes)
+        return self.eigenvalues, self.eigenvectors
+
+    # the n_eigenpairs smallest eigenpairs of sparse laplacian, for large graphs
+    def get_partial_spectrum(self) -> (np.ndarray, np.ndarray):
+        return cached_eigsh(self.sparse_L, self.nodes, min(self.n_eigenpairs, self.n_node))
+
+    # error bound of the 'lanczos' heat kernel at scale, from the cached partial spectrum, kept in self.truncation_errors
+    def get_truncation_error(self, scale) -> float:
+        if scale not in self.truncation_errors:
+            eigenvalues, _ = self.get_partial_spectrum()
+            self.truncation_errors[scale] = wavelet_backend.truncation_error(eigenvalues, scale)
+        return self.truncation_errors[scale]
+
+    # pygsp graph with estimated lmax, built once per graph operator
+    def get_pygsp_graph(self) -> pygsp.graphs.Graph:
+        return self.operator.get_pygsp_graph()
+
+    # chebyshev coefficients of heat kernel at scale, with the lowest order meeting self.chebyshev_tol.
+    # the order is chosen by the truncation error alone, the order and the error bound of the damped series
+    # of each scale are kept in self.chebyshev_orders and self.chebyshev_errors,
+    # the damping part of the bound in self.chebyshev_damping_losses
+    def get_chebyshev_coeffs(self, scale) -> np.ndarray:
+        return self.chebyshev.get(scale)
+
+    # float matrix of the model's dtype, backed by a memmap file if self.scratch_dir is set
+    def new_matrix(self, n_rows, n_cols) -> np.ndarray:
+        if self.scratch_dir is None:
+            return np.zeros((n_rows, n_cols), dtype=self.dtype)
+        return scratch.memmap_array((n_rows, n_cols), self.dtype, self.scratch_dir)
+
+    # shape of distance results, (n, n) or the condensed (n * (n - 1) / 2, )
+    def distance_shape(self) -> tuple:
+        if self.condensed_distance:
+            return (condensed.condensed_size(self.n_node), )
+        return (self.n_node, self.n_node)
+
+    # zero distances of self.distance_dtype, backed by a memmap file if self.scratch_dir is set
+    def new_distance_matrix(self) -> np.ndarray:
+        if self.scratch_dir is None:
+            return np.zeros(self.distance_shape(), dtype=self.distance_dtype)
+        return scratch.memmap_array(self.distance_shape(), self.distance_dtype, self.scratch_dir)
+
+    # producers only fill the upper triangle, a square result gets its lower triangle here
+    def finish_distance_matrix(self, dist_mat) -> np.ndarray:
+        if dist_mat.ndim == 1:
+            return dist_mat
+        return scratch.symmetrize_upper(dist_mat, self.get_block_rows())
+
+    # rows per block of producers and consumers, bounded by the working set when out of core
+    def get_block_rows(self, n_buffers=1) -> int:
+        if self.scratch_dir is None:
+            return self.block_size
+        return min(self.block_size, scratch.rows_per_block(self.n_node, self.dtype, self.working_set_bytes,
+                                                           n_buffers))
+
     # caculate wavelet coefficients
-    # approx: if True then use chebshev polynomials
-    def calculate_wavelets(self, scale, approx=True) -> np.ndarray:
-        if approx:
-            G = pygsp.graphs.Graph(self.A)
-            G.estimate_lmax()
-            heat_filter = pygsp.filters.Heat(G, tau=[scale * G._lmax])
-            chebyshev = pygsp.filters.approximations.compute_cheby_coeff(heat_filter, m=50)
-            wavelets = np.empty(shape=(self.n_node, self.n_node))
-            for idx in range(self.n_node):
-                impulse = np.zeros(self.n_node, dtype=np.float)
-                impulse[idx] = 1.0
-                coeff = pygsp.filters.approximations.cheby_op(G, chebyshev, impulse)
-                wavelets[idx, :] = coeff
-        else:
-            eigenvalues, eigenvectors = np.linalg.eigh(self.L)
-            wavelets = np.dot(np.dot(eigenvectors, np.diag(np.exp(-1 * scale * eigenvalues))),
-                                 np.transpose(eigenvectors))
+    # approx: if True then use chebshev polynomials, if False use eigen decomposition,
+    #         the chebshev order of each scale is chosen by self.get_chebyshev_coeffs,
+    #         'block' runs chebshev polynomials on blocks of impulses over the sparse laplacian,
+    #         'lanczos' builds a low-rank heat kernel from the partial spectrum,
+    #         the error bound of each scale is kept in self.truncation_errors, its wavelets are always lazy WaveletRows
+    #         (cached within self.wavelet_cache_bytes, or self.working_set_bytes if not set),
+    #         so memory stays O(n * k) for the spectrum plus the cache instead of a dense n x n matrix,
+    #         'expm' applies exp(-scale * L) on blocks of impulses with krylov expm_multiply.
+    # nodes: if given, only the wavelets of these nodes are computed, row i belongs to nodes[i].
+    # returns lazy WaveletRows if self.wavelet_cache_bytes is set or approx is 'lanczos',
+    # otherwise a CSR matrix if self.sparse_wavelets, else a dense one (a memmap if self.scratch_dir is set).
+    def calculate_wavelets(self, scale, approx=True, nodes=None):
+        rows = None if nodes is None else [self.node2idx[node] for node in nodes]
+        if approx == "lanczos":
+            self.get_truncation_error(scale)
+        if self.wavelet_cache_bytes is not None:
+            return self.lazy_wavelets(scale, approx, self.wavelet_cache_bytes, rows)
+        if approx == "lanczos":
+            return self.lazy_wavelets(scale, approx, self.working_set_bytes, rows)
+        out = None
+        if self.scratch_dir is not None and not self.sparse_wavelets:
+            out = self.new_matrix(self.n_node if rows is None else len(rows), self.n_node)
+        # a chebyshev block keeps about 5 dense buffers alive
+        return wavelet_backend.assemble_wavelets(lambda cols: self.calculate_wavelet_rows(scale, approx, cols),
+                                                 self.n_node, self.get_block_rows(n_buffers=5),
+                                                 1e-4 * 1.0 / self.n_node, sparse_output=self.sparse_wavelets,
+                                                 rows=rows, dtype=self.dtype, out=out)
+
+    # wavelets computed on demand in blocks, see tools.wavelets.WaveletRows
+    def lazy_wavelets(self, scale, approx=True, max_bytes=1 << 30, rows=None) -> wavelet_backend.WaveletRows:
+        return wavelet_backend.WaveletRows(functools.partial(self.calculate_wavelet_rows, scale, approx),
+                                           self.n_node, block_size=self.block_size,
+                                           eps=1e-4 * 1.0 / self.n_node, max_bytes=max_bytes, rows=rows,
+                                           sparse_blocks=self.sparse_wavelets, dtype=self.dtype)
 
-        threshold = np.vectorize(lambda x: x if x > 1e-4 * 1.0 / self.n_node else 0)
-        wavelets = threshold(wavelets)
-        return wavelets
+    # wavelet coefficients of the given rows (node indices), before thresholding
+    def calculate_wavelet_rows(self, scale, approx, rows) -> np.ndarray:
+        if approx == "block":
+            return wavelet_backend.chebyshev_op(self.sparse_L, self.get_chebyshev_coeffs(scale), self.get_lmax(),
+                                                wavelet_backend.impulses(self.n_node, rows, self.dtype)).T
+        elif approx == "lanczos":
+            eigenvalues, eigenvectors = self.get_partial_spectrum()
+            return wavelet_backend.heat_kernel_rows(eigenvalues, eigenvectors, scale, rows, self.dtype)
+        elif approx == "expm":
+            return wavelet_backend.expm_rows(self.sparse_L, scale, rows, self.dtype)
+        elif approx:
+            return self.operator.pygsp_heat_rows(scale, self.chebyshev.order(scale), self.chebyshev_damping, rows,
+                                                 self.dtype)
+        else:
+            eigenvalues, eigenvectors = self.get_spectrum()
+            return wavelet_backend.heat_kernel_rows(eigenvalues, eigenvectors, scale, rows, self.dtype)
 
 
     # 得到系数的分层表示
@@ -74,15 +229,44 @@ class HSD(object):
             neighbor_layers = self.hierarchy[node]
             coeffs = []
             for neighbor_set in neighbor_layers:
-                tmp = []
-                for neighbor in neighbor_set:
-                    idx2 = self.node2idx[neighbor]
-                    tmp.append(wavelets[idx, idx2])
-                coeffs.append(tmp)
+                idx2 = [self.node2idx[neighbor] for neighbor in neighbor_set]
+                coeffs.append(list(wavelet_backend.row_values(wavelets, idx, idx2)))
             coeffs_dict[node] = coeffs
         return coeffs_dict
 
 
+    # sorted coefficients of every hop layer, stored as one ragged array for the pairwise loop.
+    # the hop-h profile of node i is values[offsets[r]: offsets[r + 1]], r = i * (hop + 1) + h
+    def get_profiles(self, wavelets) -> (np.ndarray, np.ndarray):
+        members, offsets = hierarchy_to_rings(self.hierarchy, self.nodes, self.node2idx, self.hop)
+        return wavelet_backend.ring_profiles(wavelets, members, offsets, self.hop + 1), offsets
+
+
+    # profiles of wavelets into self.profile_values and self.profile_offsets, by default of self.wavelets,
+    # or of the wavelets of self.scale if it is not set either.
+    # profiles of the model's own wavelets are reused as long as self.wavelets (or self.scale without wavelets)
+    # is what they were built from, profiles of other wavelets, e.g. the scales of MultiHSD, are never reused.
+    def load_profiles(self, wavelets=None):
+        if wavelets is not None:
+            source = None
+        elif self.wavelets is not None:
+            source = weakref.ref(self.wavelets)
+        else:
+            source = ("scale", self.scale)
+        if source is None or self.profile_values is None or not self._same_profile_source(source):
+            if wavelets is None:
+                wavelets = self.wavelets if self.wavelets is not None else self.calculate_wavelets(self.scale)
+            self.profile_values, self.profile_offsets = self.get_profiles(wavelets)
+            self.profile_source = source
+        return self.profile_values, self.profile_offsets
+
+
+    def _same_profile_source(self, source) -> bool:
+        if isinstance(source, weakref.ref) and isinstance(self.profile_source, weakref.ref):
+            return self.profile_source() is not None and self.profile_source() is source()
+        return source == self.profile_source
+
+
     # 作为baseline，统计节点各hop邻居的个数，组成向量
     def get_nodes_hierarchical_degree(self) -> dict:
         hierarchical_degrees = dict()
@@ -95,12 +279,26 @@ class HSD(object):
 
 
     # calculate HSD using a single thread
-    def calculate_structural_distance(self, scale, approx=False):
+    # vectorized: if True, each hop's coefficients are sorted once and W1 of a node against all later nodes
+    #             is computed at once by metrics.wasserstein_upper, else scipy is called for every pair.
+    # returns the (n, n) matrix, or its condensed vector if self.condensed_distance is set
+    # out: if given, distances are added to its upper triangle, which is left unsymmetrized, e.g. to sum scales
+    def calculate_structural_distance(self, scale, approx=False, vectorized=True, out=None):
         wavelets = self.calculate_wavelets(scale, approx)
         coeffs_dict = self.get_hierarchical_coeffcients(wavelets)
+        scratch.release(wavelets)
+
+        dist_mat = self.new_distance_matrix() if out is None else out
+        if vectorized:
+            rings = self.get_sorted_rings(coeffs_dict)
+            for start, end in tqdm(list(scratch.iter_row_blocks(self.n_node, self.get_block_rows()))):
+                for values, offsets in rings:
+                    metrics.wasserstein_upper(values, offsets, dist_mat, range(start, end))
+                scratch.drop_pages(dist_mat)
+            return self.finish_distance_matrix(dist_mat) if out is None else out
 
-        dist_mat = np.zeros((self.n_node, self.n_node), dtype=float)
         for idx1, node1 in tqdm(enumerate(self.nodes)):
+            row = condensed.upper_row(dist_mat, idx1)
             for idx2 in range(idx1 + 1, self.n_node):
                 node2 = self.nodes[idx2]
                 coeffs_layers1, coeffs_layers2 = coeffs_dict[node1], coeffs_dict[node2]
@@ -109,53 +307,334 @@ class HSD(object):
                     # coeffs doesn't have to share same length
                     coeffs1, coeffs2 = coeffs_layers1[hop], coeffs_layers2[hop]
                     distance += wasserstein_distance(coeffs1, coeffs2)
-                dist_mat[idx1, idx2] = dist_mat[idx2, idx1] = distance
+                row[idx2 - idx1 - 1] += distance
+
+        return self.finish_distance_matrix(dist_mat) if out is None else out
+
+
+    # sorted coefficients of every hop, one (values, offsets) pair per hop, see metrics.sorted_distributions
+    def get_sorted_rings(self, coeffs_dict: dict) -> list:
+        return [metrics.sorted_distributions([coeffs_dict[node][hop] for node in self.nodes])
+                for hop in range(self.hop + 1)]
+
+
+    # the k structurally nearest nodes of every node, without building the distance matrix:
+    # W1 distances are computed in row tiles and merged into bounded neighbour lists (see tools.knn).
+    # returns the kNN graph as an (n, n) CSR matrix of distances, nearest first in every row,
+    # and saves it as a distance edgelist if save_path is given.
+    def calculate_structural_neighbors(self, k, scale=None, approx=False, save_path=None):
+        scale = self.scale if scale is None else scale
+        wavelets = self.calculate_wavelets(scale, approx)
+        rings = self.get_sorted_rings(self.get_hierarchical_coeffcients(wavelets))
+        scratch.release(wavelets)
+        return self.neighbors_from_rings(rings, k, save_path)
+
+
+    # kNN graph of the summed W1 distances over rings, see calculate_structural_neighbors
+    def neighbors_from_rings(self, rings, k, save_path=None):
+        heap = knn.NeighborHeap(self.n_node, k)
+        for start, end in tqdm(list(scratch.iter_row_blocks(self.n_node, self.get_block_rows()))):
+            tile = np.zeros((end - start, self.n_node))
+            for values, offsets in rings:
+                metrics.wasserstein_upper(values, offsets, tile, range(start, end), first_row=start)
+            heap.push_upper_tile(start, tile)
+        if save_path is not None:
+            rw.save_edgelist(save_path, heap.to_edgelist(self.nodes))
+        return heap.to_csr()
+
+
+    # size, mean and scatter of every ring of the profiles, each (n, hop + 1), see metrics.gauss_ring_moments
+    def get_gauss_moments(self) -> tuple:
+        moments = metrics.gauss_ring_moments(self.profile_values, self.profile_offsets)
+        return tuple(m.reshape((self.n_node, self.hop + 1)) for m in moments)
 
-        return dist_mat
+
+    # HSD under metric 'wasserstein_guass' summed over hops and over the moments of several scales,
+    # the distance of a pair only depends on the moments of its rings, so no pair is visited one by one:
+    # row tiles against all later columns are filled by broadcasting (metrics.wasserstein_guass_tile).
+    def gauss_distance_matrix(self, moments_list) -> np.ndarray:
+        dist_mat = self.new_distance_matrix()
+        block_rows = self.get_block_rows(n_buffers=8)
+        for start, end in scratch.iter_row_blocks(self.n_node, block_rows):
+            tile = np.zeros((end - start, self.n_node - start), dtype=np.float64)
+            for moments in moments_list:
+                for hop in range(self.hop + 1):
+                    tile += metrics.wasserstein_guass_tile([m[start:end, hop] for m in moments],
+                                                           [m[start:, hop] for m in moments])
+            for i in range(start, end):
+                condensed.upper_row(dist_mat, i)[...] = tile[i - start, i - start + 1:]
+            scratch.drop_pages(dist_mat)
+        return self.finish_distance_matrix(dist_mat)
+
+
+    # quantile vectors of the profiles, the L1 distance of two vectors is the summed W1 over hops of
+    # the rings zero padded to the largest ring of their hop (metrics.ring_quantiles), up to self.quantile_errors:
+    #   L1(v_i, v_j) <= sum_h W1 <= L1(v_i, v_j) + quantile_errors[i] + quantile_errors[j],
+    # and exact for hops whose largest ring has at most n_quantiles nodes.
+    # parallel_calculate_HSD pads every pair to its own larger ring m_h instead, zeros inserted into both rings
+    # scale W1 by the padded length, so its hop-h distance is exactly max_h / m_h times the one embedded here.
+    # returns {node: vector} of length (hop + 1) * n_quantiles at most, like MultiHSD.embed
+    def quantile_embed(self, n_quantiles=32, wavelets=None) -> dict:
+        vectors = self.quantile_vectors(n_quantiles, wavelets)
+        return {node: vectors[i] for i, node in enumerate(self.nodes)}
+
+
+    # (n, d) matrix of quantile_embed, rows in the order of self.nodes
+    def quantile_vectors(self, n_quantiles=32, wavelets=None) -> np.ndarray:
+        values, offsets = self.load_profiles(wavelets)
+        negatives = metrics.ring_negatives(values, offsets)
+        sizes = np.diff(offsets).reshape((self.n_node, self.hop + 1))
+        blocks = []
+        self.quantile_errors = np.zeros(self.n_node)
+        for hop in range(self.hop + 1):
+            rings = np.arange(self.n_node) * (self.hop + 1) + hop
+            block, errors = metrics.ring_quantiles(values, offsets, rings, int(sizes[:, hop].max(initial=0)),
+                                                   n_quantiles, negatives)
+            blocks.append(block)
+            self.quantile_errors += errors
+        return np.concatenate(blocks, axis=1)
+
+
+    # distance matrix of quantile_embed, filled by cdist(cityblock) row tiles against all later columns
+    def quantile_distance_matrix(self, n_quantiles=32, wavelets=None) -> np.ndarray:
+        vectors = self.quantile_vectors(n_quantiles, wavelets)
+        dist_mat = self.new_distance_matrix()
+        for start, end in scratch.iter_row_blocks(self.n_node, self.get_block_rows()):
+            tile = cdist(vectors[start:end], vectors[start:], "cityblock")
+            for i in range(start, end):
+                condensed.upper_row(dist_mat, i)[...] = tile[i - start, i - start + 1:]
+            scratch.drop_pages(dist_mat)
+        self.distMat = self.finish_distance_matrix(dist_mat)
+        return self.distMat
+
+
+    # kNN graph of quantile_embed as an (n, n) CSR matrix, see calculate_structural_neighbors
+    def quantile_structural_neighbors(self, k, n_quantiles=32, wavelets=None, save_path=None):
+        vectors = self.quantile_vectors(n_quantiles, wavelets)
+        heap = knn.NeighborHeap(self.n_node, k)
+        for start, end in scratch.iter_row_blocks(self.n_node, self.get_block_rows()):
+            tile = np.zeros((end - start, self.n_node))
+            tile[:, start:] = cdist(vectors[start:end], vectors[start:], "cityblock")
+            heap.push_upper_tile(start, tile)
+        if save_path is not None:
+            rw.save_edgelist(save_path, heap.to_edgelist(self.nodes))
+        return heap.to_csr()
 
 
     # calculate HSD parallelly
-    def parallel_calculate_HSD(self, n_workers=3):
-        distMat = np.zeros((self.n_node, self.n_node), dtype=float)
-        pool = multiprocessing.Pool(n_workers)
-        states = {}
-        for idx in range(self.n_node):
-            res = pool.apply_async(HSD._calculate_worker, args=(self, idx))
-            states[idx] = res
-        pool.close()
-        pool.join()
-
-        results = []
-        for idx in range(self.n_node):
-            results.append(states[idx].get())
-
-        for idx1, dists in enumerate(results):
-            for idx2 in range(idx1 + 1, self.n_node):
-                distMat[idx1, idx2] = distMat[idx2, idx1] = dists[idx2]
+    # wavelets: defaults to self.wavelets, or the wavelets of self.scale if it is not set either
+    # executor: a tools.parallel.Executor, defaults to the shared one with n_workers processes
+    # profiles and the output matrix are shared with the workers once (see tools.parallel),
+    # the upper triangle is split into tiles_per_worker * n_workers contiguous row blocks of about the same cost
+    # (pairs weighted by profile lengths), idle workers take the next block and write its rows into the output.
+    # per-worker busy time and utilization of the run are kept in self.parallel_stats.
+    # checkpoint_dir: if set, workers write into a memmap in a job directory under it (tools.checkpoint),
+    # finished blocks are logged, and calling again with the same graph, hop, metric and profiles
+    # resumes where a killed run stopped.
+    # metric 'wasserstein_guass' only needs ring moments and is computed in this process, see gauss_distance_matrix,
+    # it is not checkpointed and ignores checkpoint_dir
+    def parallel_calculate_HSD(self, n_workers=3, wavelets=None, executor=None, tiles_per_worker=8,
+                               checkpoint_dir=None):
+        self.load_profiles(wavelets)
+        if str.lower(self.metric) == "wasserstein_guass":
+            self.distMat = self.gauss_distance_matrix([self.get_gauss_moments()])
+            return self.distMat
 
-        self.distMat = distMat
+        executor = parallel.get_executor(n_workers) if executor is None else executor
+        distMat = self.new_distance_matrix()
+        sizes = np.diff(self.profile_offsets).reshape((self.n_node, self.hop + 1)).sum(axis=1)
+        blocks = parallel.triangle_row_blocks(self.n_node, tiles_per_worker * executor.n_workers,
+                                              parallel.triangle_row_costs(sizes, pair_cost=self.hop + 1))
+        store = None
+        if checkpoint_dir is not None:
+            store = checkpoint.Checkpoint(checkpoint_dir, self.checkpoint_params(
+                "HSD.parallel_calculate_HSD", scale=float(self.scale), metric=str.lower(self.metric),
+                profiles=checkpoint.array_digest(self.profile_values, self.profile_offsets),
+                shape=list(self.distance_shape()), distance_dtype=self.distance_dtype.str))
+            blocks = [tuple(block) for block in store.setdefault("blocks", [list(block) for block in blocks])]
+        with parallel.SharedArrays() as shared:
+            specs = [shared.put(self.profile_values), shared.put(self.profile_offsets)]
+            if store is not None:
+                out = store.memmap("distances", self.distance_shape(), self.distance_dtype)
+                specs.append(parallel.memmap_spec(out))
+            elif isinstance(distMat, np.memmap):
+                specs.append(parallel.memmap_spec(distMat))
+                out = None
+            else:
+                spec, out = shared.zeros(distMat.shape, distMat.dtype)
+                specs.append(spec)
+            todo = [block for block in blocks if store is None or not store.is_done(f"{block[0]}-{block[1]}")]
+            for index, _ in executor.imap(_row_block_worker, todo, (specs, self.metric, self.hop + 1)):
+                if store is not None:
+                    store.mark_done(f"{todo[index][0]}-{todo[index][1]}")
+            self.parallel_stats = executor.stats
+            if out is not None:
+                # a block of a condensed vector is as long as block_rows full rows
+                block_rows = self.get_block_rows() * (self.n_node if out.ndim == 1 else 1)
+                for start, end in scratch.iter_row_blocks(len(out), block_rows):
+                    distMat[start:end] = out[start:end]
+                    scratch.drop_pages(distMat)
+                del out
+
+        self.distMat = self.finish_distance_matrix(distMat)
         return self.distMat
 
 
-    def _calculate_worker(self, startIndex: int) -> np.ndarray:
-        dists = np.zeros(self.n_node)
-        node = self.nodes[startIndex]
-        layers = self.hierarchy[node]
-        for idx in range(startIndex + 1, self.n_node):
-            other = self.nodes[idx]
-            _layers = self.hierarchy[other]
-            d = 0.0
-            for hop in range(self.hop):
-                r1, r2 = layers[hop], _layers[hop]
-                p, q = [], []
-                for neighbor in r1:
-                    p.append(self.wavelets[startIndex, self.node2idx[neighbor]])
-
-                for neighbor in r2:
-                    q.append(self.wavelets[startIndex, self.node2idx[neighbor]])
-
-                d += metrics.calculate_distance(p, q, self.metric)
-
-            dists[idx] = d
+    # parameters that decide the result of a checkpointed job, see tools.checkpoint:
+    # the graph by its laplacian hash (which includes the node order), hop and the hierarchy of rings,
+    # and with approx, the wavelet backend and every setting its wavelets depend on (see wavelet_params)
+    def checkpoint_params(self, job: str, approx=None, **params) -> dict:
+        members, offsets = hierarchy_to_rings(self.hierarchy, self.nodes, self.node2idx, self.hop)
+        params.update(job=job, graph=laplacian_hash(self.sparse_L, self.nodes), hop=self.hop,
+                      rings=checkpoint.array_digest(members, offsets))
+        if approx is not None:
+            params.update(self.wavelet_params(approx))
+        return params
 
+
+    # settings of calculate_wavelets under a backend: precision, thresholding, the chebyshev order
+    # and the lmax it is scaled by, or the size of the partial spectrum
+    def wavelet_params(self, approx) -> dict:
+        params = dict(approx=approx, dtype=self.dtype.str, sparse_wavelets=self.sparse_wavelets,
+                      threshold=1e-4 * 1.0 / self.n_node)
+        if approx is True or approx == "block":
+            params.update(chebyshev_tol=self.chebyshev_tol, chebyshev_damping=self.chebyshev_damping,
+                          lmax=float(self.get_lmax()))
+        elif approx == "lanczos":
+            params.update(n_eigenpairs=int(min(self.n_eigenpairs, self.n_node)))
+        return params
+
+
+    # distances of node startIndex to all later nodes, read from the precomputed profiles
+    def _calculate_worker(self, startIndex: int) -> np.ndarray:
+        dists = np.zeros(self.n_node, dtype=self.dtype)
+        dists[startIndex + 1:] = profile_row_distances(self.profile_values, self.profile_offsets,
+                                                       self.hop + 1, self.metric, startIndex)
         return dists
+
+
+    # the k structurally nearest nodes of each query node by the profile distance of parallel_calculate_HSD.
+    # with metric 'wasserstein', candidates are visited in the order of a lower bound (wasserstein_lower_bounds)
+    # and the exact distance stops being evaluated once the bound reaches the current k-th distance.
+    # batch: exact distances evaluated between two checks of the bound
+    # returns {node: [(neighbor, distance), ...]} nearest first, counts of exact evaluations are kept in self.pruning_stats
+    def query_structural_neighbors(self, nodes, k, wavelets=None, batch=32) -> dict:
+        self.load_profiles(wavelets)
+        values, offsets, n_layers = self.profile_values, self.profile_offsets, self.hop + 1
+        summaries = profile_summaries(values, offsets, n_layers)
+        negatives = metrics.ring_negatives(values, offsets)
+        prunable = str.lower(self.metric) == "wasserstein"
+
+        neighbors = dict()
+        n_exact = 0
+        for node in nodes:
+            i = self.node2idx[node]
+            bounds = wasserstein_lower_bounds(summaries, i) if prunable else np.zeros(self.n_node)
+            bounds[i] = np.inf
+            order = np.argsort(bounds, kind="stable")[:self.n_node - 1]
+            found, dists = np.empty(0, dtype=np.int64), np.empty(0)
+            for start in range(0, len(order), batch):
+                if len(found) == k and bounds[order[start]] >= dists[-1]:
+                    break
+                others = order[start:start + batch]
+                found = np.concatenate([found, others])
+                dists = np.concatenate([dists, profile_distances(values, offsets, n_layers, self.metric, i, others,
+                                                                 negatives=negatives)])
+                n_exact += len(others)
+                keep = np.argsort(dists, kind="stable")[:k]
+                found, dists = found[keep], dists[keep]
+            neighbors[node] = [(self.nodes[j], float(d)) for j, d in zip(found, dists)]
+
+        n_pairs = len(neighbors) * (self.n_node - 1)
+        self.pruning_stats = {"queries": len(neighbors), "pairs": n_pairs, "exact": n_exact,
+                              "pruned": 1.0 - n_exact / max(n_pairs, 1)}
+        return neighbors
+
+
+    # workers read the profiles, the wavelets are not sent to them
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["wavelets"] = None
+        state["profile_source"] = None
+        return state
+
+
+# distances of node i to the nodes after it, summed over n_layers rings of the profiles
+def profile_row_distances(values, offsets, n_layers, metric, i, negatives=None) -> np.ndarray:
+    n_node = (len(offsets) - 1) // n_layers
+    return profile_distances(values, offsets, n_layers, metric, i, range(i + 1, n_node), negatives=negatives)
+
+
+# distances of node i to the given nodes, summed over n_layers rings of the profiles.
+# pairs of rings are aligned into padded arrays and measured by metrics.batch_ring_distance, hop by hop,
+# with the other nodes sorted by ring size so that a padded block holds rings of similar length.
+# batch_size bounds the number of padded entries per call.
+# negatives: metrics.ring_negatives of the profiles, pass it when calling repeatedly
+def profile_distances(values, offsets, n_layers, metric, i, others, batch_size=1 << 20, negatives=None) -> np.ndarray:
+    others = np.asarray(others, dtype=np.int64)
+    dists = np.zeros(len(others), dtype=values.dtype)
+    sizes = np.diff(offsets)
+    negatives = metrics.ring_negatives(values, offsets) if negatives is None else negatives
+    for hop in range(n_layers):
+        ring = i * n_layers + hop
+        rings = others * n_layers + hop
+        widths = np.maximum(sizes[rings], sizes[ring])
+        order = np.argsort(widths, kind="stable")
+        sorted_widths = np.maximum(widths[order], 1)
+        start = 0
+        while start < len(order):
+            # padded entries of rows start..end - 1 is (end - start) * sorted_widths[end - 1]
+            ends = np.arange(start + 1, len(order) + 1)
+            costs = (ends - start) * sorted_widths[start:]
+            end = start + max(1, int(np.searchsorted(costs, batch_size, side="right")))
+            block = order[start:end]
+            dists[block] += metrics.batch_ring_distance(values, offsets, np.full(len(block), ring), rings[block],
+                                                        metric, negatives)
+            start = end
+    return dists
+
+
+# per-ring summaries of the profiles for lower bounds: sizes (the hierarchical degrees),
+# sums and sums of absolute values, each of shape (n, n_layers)
+def profile_summaries(values, offsets, n_layers) -> (np.ndarray, np.ndarray, np.ndarray):
+    n_rings = len(offsets) - 1
+    sizes = np.diff(offsets)
+    padded = np.append(values, 0.0)
+    sums = np.where(sizes > 0, np.add.reduceat(padded, offsets[:-1]), 0.0)
+    abs_sums = np.where(sizes > 0, np.add.reduceat(np.abs(padded), offsets[:-1]), 0.0)
+    shape = (n_rings // n_layers, n_layers)
+    return sizes.reshape(shape), sums.reshape(shape), abs_sums.reshape(shape)
+
+
+def wasserstein_lower_bounds(summaries, i) -> np.ndarray:
+    """
+    Lower bounds of the profile distance (metric 'wasserstein') between node i and every node.
+    Per hop, p and q are zero padded to the same length M = max(len(p), len(q)) and W1 = mean|p_t - q_t|
+    over sorted values, so W1 >= |sum f(p) - sum f(q)| / M for any 1-Lipschitz f; f(x) = x and f(x) = |x|
+    are used, the zeros of the padding add nothing to either sum.
+    :param summaries: see `profile_summaries`
+    :return: (n, )
+    """
+    sizes, sums, abs_sums = summaries
+    longest = np.maximum(np.maximum(sizes, sizes[i]), 1)
+    bounds = np.maximum(np.abs(sums - sums[i]), np.abs(abs_sums - abs_sums[i])) / longest
+    # the sums are rounded, keep the bound below the exact distance
+    return np.sum(bounds, axis=1) * (1 - 1e-9)
+
+
+# fill out[i, i+1:] for the rows of a block, only (start, end) is sent to the worker,
+# profiles and output are attached on the first block of a job and kept in parallel.job_state
+def _row_block_worker(context, block):
+    state = parallel.job_state()
+    if not state:
+        specs, metric, n_layers = context
+        values, offsets, out = [parallel.attach(spec) for spec in specs]
+        state.update(values=values, offsets=offsets, out=out, metric=metric, n_layers=n_layers,
+                     negatives=metrics.ring_negatives(values, offsets))
+    out = state["out"]
+    for i in range(*block):
+        condensed.upper_row(out, i)[...] = profile_row_distances(state["values"], state["offsets"], state["n_layers"],
+                                                                 state["metric"], i, state["negatives"])
+    if isinstance(out, np.memmap):
+        scratch.drop_pages(out)
+    return block
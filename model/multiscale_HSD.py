@@ -2,20 +2,28 @@
 
 # Multi-scales HSD implementataion
 
-import multiprocessing
 from collections import defaultdict
 import networkx as nx
 import numpy as np
-import pygsp
 from tqdm import tqdm
 from model import HSD
+from tools import checkpoint
 from tools import hierarchy
+from tools import parallel
+from tools import scratch
+from tools import wavelets as wavelet_backend
 
 
 class MultiHSD(HSD):
 
-    def __init__(self, graph: nx.Graph, graphName: str, hop: int, n_scales: int, metric="euclidean"):
-        super(MultiHSD, self).__init__(graph, graphName, 0, hop, metric)
+    def __init__(self, graph: nx.Graph, graphName: str, hop: int, n_scales: int, metric="euclidean",
+                 approx=True, **kwargs):
+        """
+        :param approx: wavelet backend used for every scale, see `HSD.calculate_wavelets`
+        :param kwargs: passed to HSD, e.g. block_size
+        """
+        super(MultiHSD, self).__init__(graph, graphName, 0, hop, metric, **kwargs)
+        self.approx = approx
         self.n_scales = n_scales
         self.scales = None
         self.embeddings = None
@@ -24,34 +32,104 @@ class MultiHSD(HSD):
 
 
     def init(self):
-        G = pygsp.graphs.Graph(self.A)
-        G.estimate_lmax()
         # 如何取scales?
-        self.scales = np.exp(np.linspace(np.log(0.01), np.log(G._lmax*1.25), self.n_scales))
+        self.scales = np.exp(np.linspace(np.log(0.01), np.log(self.get_lmax()*1.25), self.n_scales))
         self.hierarchy = hierarchy.read_hierarchical_representation(self.graphName, self.hop)
 
 
+    # error bounds of the 'lanczos' wavelets of every scale into self.truncation_errors,
+    # the workers of the parallel paths compute them in their own processes
+    def record_truncation_errors(self):
+        if self.approx == "lanczos":
+            for scale in self.scales:
+                self.get_truncation_error(scale)
+
+
     # embed nodes into vectors using multi-scale wavelets
-    def embed(self) -> dict:
+    # nodes: only embed these nodes, the wavelets of other nodes are never computed
+    def embed(self, nodes=None) -> dict:
+        if self.approx == "expm":
+            return self.expm_embed(nodes)
         embeddings = defaultdict(list)
         for scale in tqdm(self.scales):
-            wavelets = self.calculate_wavelets(scale, approx=True)
-            for node in self.nodes:
-                embeddings[node].extend(self.get_triple(wavelets, node))
-               # embeddings[node].extend(self.get_layer_sum(wavelets, node))
+            wavelets = self.calculate_wavelets(scale, approx=self.approx, nodes=nodes)
+            for row, node in enumerate(self.nodes if nodes is None else nodes):
+                embeddings[node].extend(self.get_triple(wavelets, node, row))
+               # embeddings[node].extend(self.get_layer_sum(wavelets, node, row))
+        return embeddings
+
+
+    # embed nodes using chebyshev moments shared by all scales:
+    # the recurrence runs once, each scale only costs a coefficient-matrix product.
+    # unlike embed(), small wavelet coefficients are not thresholded.
+    # order: fixed chebyshev order, by default the largest adaptive order over scales (see get_chebyshev_coeffs)
+    def moment_embed(self, order=None, nodes=None) -> dict:
+        nodes = self.nodes if nodes is None else list(nodes)
+        rows = [self.node2idx[node] for node in nodes]
+        members, offsets = hierarchy.hierarchy_to_rings(self.hierarchy, nodes, self.node2idx, self.hop)
+        n_layers = self.hop + 1
+        lmax = self.get_lmax()
+        if order is None:
+            adaptive = [self.get_chebyshev_coeffs(scale) for scale in self.scales]
+            order = max(len(c) for c in adaptive) - 1
+            # higher terms of a lower order scale are zero
+            coeffs = np.stack([np.pad(c, (0, order + 1 - len(c))) for c in adaptive], axis=1)
+        else:
+            coeffs = np.stack([wavelet_backend.chebyshev_coeffs(scale, lmax, order) for scale in self.scales], axis=1)
+        moments = wavelet_backend.chebyshev_ring_moments(self.sparse_L, lmax, order, members, offsets, n_layers,
+                                                         block_size=self.block_size, rows=rows, dtype=self.dtype)
+        coeffs = coeffs.astype(self.dtype)
+        # (len(nodes), n_layers, n_scales)
+        sums = moments @ coeffs
+        sizes = np.diff(offsets).reshape((len(nodes), n_layers, 1))
+        means = np.divide(sums, sizes, out=np.zeros_like(sums), where=sizes > 0)
+        # same layout as embed(): scale by scale, [sum, mean] per hop
+        vectors = np.stack([sums, means], axis=2).transpose((0, 3, 1, 2)).reshape((len(nodes), -1))
+
+        embeddings = defaultdict(list)
+        for idx, node in enumerate(nodes):
+            embeddings[node] = list(vectors[idx])
+        self.embeddings = embeddings
+        return embeddings
+
+
+    # embed nodes with expm_multiply: each block of impulses sweeps the whole scale grid at once,
+    # descriptors are the same [sum, mean] per hop as get_triple.
+    def expm_embed(self, nodes=None) -> dict:
+        nodes = self.nodes if nodes is None else list(nodes)
+        rows = [self.node2idx[node] for node in nodes]
+        members, offsets = hierarchy.hierarchy_to_rings(self.hierarchy, nodes, self.node2idx, self.hop)
+        n_layers = self.hop + 1
+        sizes = np.diff(offsets).reshape((len(nodes), n_layers))
+        eps = 1e-4 * 1.0 / self.n_node
+        vectors = np.zeros((len(nodes), self.n_scales, n_layers, 2), dtype=self.dtype)
+        for start, cols in zip(range(0, len(nodes), self.block_size),
+                               wavelet_backend.iter_impulse_blocks(self.n_node, self.block_size, rows)):
+            block = np.arange(start, start + len(cols))
+            responses = wavelet_backend.expm_scale_grid(self.sparse_L, self.scales,
+                                                        wavelet_backend.impulses(self.n_node, cols, self.dtype))
+            for idx in range(self.n_scales):
+                sums = wavelet_backend.ring_sums(wavelet_backend.threshold(responses[idx], eps), block,
+                                                 members, offsets, n_layers)
+                vectors[block, idx, :, 0] = sums
+                vectors[block, idx, :, 1] = np.divide(sums, sizes[block], out=np.zeros_like(sums),
+                                                      where=sizes[block] > 0)
+
+        embeddings = defaultdict(list)
+        for idx, node in enumerate(nodes):
+            embeddings[node] = list(vectors[idx].reshape(-1))
+        self.embeddings = embeddings
         return embeddings
 
 
-    def get_triple(self, wavelets: np.ndarray, node: str) -> list:
+    # row: row of node in wavelets, if they were computed for a subset of nodes
+    def get_triple(self, wavelets, node: str, row=None) -> list:
         descriptor = []
         neighborhoods = self.hierarchy[node]
-        node_idx = self.node2idx[node]
+        node_idx = self.node2idx[node] if row is None else row
         for hop, level in enumerate(neighborhoods):
-            coeffs = []
-            for neighbor in level:
-                if neighbor == '':
-                    continue
-                coeffs.append(wavelets[node_idx, self.node2idx[neighbor]])
+            neighbors = [self.node2idx[neighbor] for neighbor in level if neighbor != '']
+            coeffs = wavelet_backend.row_values(wavelets, node_idx, neighbors)
 
             if len(coeffs) > 0:
                 triple = [np.sum(coeffs), np.mean(coeffs)]
@@ -61,59 +139,131 @@ class MultiHSD(HSD):
         return descriptor
 
 
-    def get_layer_sum(self, wavelets: np.ndarray, node:str) -> list:
+    def get_layer_sum(self, wavelets, node:str, row=None) -> list:
         layers_sum = [0] * (self.hop + 1)
         neighborhoods = self.hierarchy[node]
-        node_idx = self.node2idx[node]
+        node_idx = self.node2idx[node] if row is None else row
         for hop, level in enumerate(neighborhoods):
-            for neighbor in level:
-                if neighbor == '':
-                    continue
-                layers_sum[hop] += wavelets[node_idx, self.node2idx[neighbor]]
+            neighbors = [self.node2idx[neighbor] for neighbor in level if neighbor != '']
+            layers_sum[hop] += np.sum(wavelet_backend.row_values(wavelets, node_idx, neighbors))
         return layers_sum
 
 
-    def parallel_embed(self, n_workers) -> dict:
-        pool = multiprocessing.Pool(n_workers)
-        states = {}
+    # descriptors of every scale are calculated by the shared executor (tools.parallel.get_executor),
+    # or by the given one, the model is sent to the workers once and only (n, d) descriptors come back.
+    # checkpoint_dir: if set, the descriptors of every finished scale are saved in a job directory under it
+    # (tools.checkpoint), and calling again with the same graph, hop, scales and wavelet settings
+    # (every parameter of the backend, see HSD.wavelet_params) skips them.
+    def parallel_embed(self, n_workers, executor=None, checkpoint_dir=None) -> dict:
+        executor = parallel.get_executor(n_workers) if executor is None else executor
+        store = None
+        if checkpoint_dir is not None:
+            store = checkpoint.Checkpoint(checkpoint_dir, self.checkpoint_params(
+                "MultiHSD.parallel_embed", scales=[float(scale) for scale in self.scales], approx=self.approx))
+        self.record_truncation_errors()
+        results = [None] * len(self.scales)
+        todo = []
         for idx, scale in enumerate(self.scales):
-            res = pool.apply_async(self.calculate_wavelets, args=(scale, True))
-            states[idx] = res
-        pool.close()
-        pool.join()
-
-        results = []
-        for idx in range(self.n_scales):
-            results.append(states[idx].get())
+            if store is not None and store.is_done(idx):
+                results[idx] = store.load(f"scale-{idx}")
+            else:
+                todo.append(idx)
+        for index, descriptors in executor.imap(_embed_worker, [self.scales[idx] for idx in todo], self):
+            idx = todo[index]
+            results[idx] = descriptors
+            if store is not None:
+                store.save(f"scale-{idx}", descriptors)
+                store.mark_done(idx)
+        self.parallel_stats = executor.stats
 
         embeddings = defaultdict(list)
-        for idx, _ in enumerate(self.scales):
-            wavelets = results[idx]
-            for node in self.nodes:
-                # 每一层简单求和
-                #embeddings[node].extend(self.get_layer_sum(wavelets, node))
-                # 每一层用三元组作为描述符
-                embeddings[node].extend(self.get_triple(wavelets, node))
+        for descriptors in results:
+            for row, node in enumerate(self.nodes):
+                embeddings[node].extend(descriptors[row].tolist())
         self.embeddings = embeddings
         return embeddings
 
 
-    def parallel_calculate_structural_distance(self, n_workers:int):
-        dist_sum_mat = np.zeros((self.n_node, self.n_node), dtype=float)
+    # sum of the structural distances of all scales.
+    # every worker adds the scales it gets into its own partial sum in shared memory (memmap files with scratch_dir),
+    # scales are handed out as workers finish them, and the partial sums are reduced once at the end,
+    # so memory grows with n_workers instead of n_scales.
+    # executor: a tools.parallel.Executor, defaults to the shared one with n_workers processes
+    # metric 'wasserstein_guass' takes the fast path of HSD.gauss_distance_matrix: the ring moments of
+    # every scale are computed once and the summed matrix is filled tile by tile in this process.
+    def parallel_calculate_structural_distance(self, n_workers:int, executor=None):
+        if str.lower(self.metric) == "wasserstein_guass":
+            moments_list = []
+            for scale in tqdm(self.scales):
+                wavelets = self.calculate_wavelets(scale, self.approx)
+                self.load_profiles(wavelets)
+                scratch.release(wavelets)
+                moments_list.append(self.get_gauss_moments())
+            return self.gauss_distance_matrix(moments_list)
+
+        executor = parallel.get_executor(n_workers) if executor is None else executor
+        self.record_truncation_errors()
+        dist_sum_mat = self.new_distance_matrix()
+        with parallel.SharedArrays() as shared:
+            if self.scratch_dir is not None:
+                partials = [self.new_distance_matrix() for _ in range(executor.n_workers)]
+                specs = [parallel.memmap_spec(partial) for partial in partials]
+            else:
+                specs, partials = zip(*[shared.zeros(self.distance_shape(), self.distance_dtype)
+                                        for _ in range(executor.n_workers)])
+            for _ in tqdm(executor.imap(_scale_worker, self.scales, (self, specs)), total=len(self.scales)):
+                pass
+            self.parallel_stats = executor.stats
+
+            self._reduce_partials(dist_sum_mat, partials)
+            for partial in partials:
+                scratch.release(partial)
+            # views of shared memory must be gone before it is closed
+            del partials, partial
+
+        return self.finish_distance_matrix(dist_sum_mat)
+
+
+    # out = sum of partials, row block by row block
+    def _reduce_partials(self, out, partials):
+        # a block of a condensed vector is as long as block_rows full rows
+        block_rows = self.get_block_rows(n_buffers=len(partials) + 1)
+        if out.ndim == 1:
+            block_rows *= self.n_node
+        for start, end in scratch.iter_row_blocks(len(out), block_rows):
+            out[start:end] = np.sum([partial[start:end] for partial in partials], axis=0)
+            for mat in [out, *partials]:
+                scratch.drop_pages(mat)
+
+
+    # the k nearest nodes under the distance summed over self.scales, as parallel_calculate_structural_distance,
+    # but only the sorted rings of every scale are kept instead of n x n matrices, see HSD.calculate_structural_neighbors
+    def multiscale_structural_neighbors(self, k, save_path=None):
+        rings = []
+        for scale in tqdm(self.scales):
+            wavelets = self.calculate_wavelets(scale, self.approx)
+            rings.extend(self.get_sorted_rings(self.get_hierarchical_coeffcients(wavelets)))
+            scratch.release(wavelets)
+        return self.neighbors_from_rings(rings, k, save_path)
+
 
-        pool = multiprocessing.Pool(n_workers)
-        result_list = []
-        for scale in self.scales:
-            res = pool.apply_async(HSD.calculate_structural_distance, args=(self, scale, True))
-            result_list.append(res)
-        pool.close()
-        pool.join()
+# descriptors of all nodes at one scale, (n, 2 * (hop + 1)), the model is the context of the job
+def _embed_worker(model, scale):
+    wavelets = model.calculate_wavelets(scale, model.approx)
+    # 每一层用三元组作为描述符, 每一层简单求和见 get_layer_sum
+    descriptors = np.array([model.get_triple(wavelets, node) for node in model.nodes], dtype=np.float64)
+    scratch.release(wavelets)
+    return descriptors.reshape((model.n_node, -1))
 
-        for res in result_list:
-            dist_mat = res.get()
-            for idx1 in range(self.n_node):
-                for idx2 in range(idx1 + 1, self.n_node):
-                    dist_sum_mat[idx1, idx2] += dist_mat[idx1, idx2]
-                    dist_sum_mat[idx2, idx1] = dist_sum_mat[idx1, idx2]
 
-        return dist_sum_mat
+# add the upper triangle of one scale to the worker's partial sum,
+# every worker owns the partial sum of its rank, attached on its first scale
+def _scale_worker(context, scale):
+    state = parallel.job_state()
+    if not state:
+        model, specs = context
+        state.update(model=model, partial=parallel.attach(specs[parallel.worker_rank()]))
+    model, partial = state["model"], state["partial"]
+    model.calculate_structural_distance(scale, model.approx, out=partial)
+    scratch.drop_pages(partial)
+    return scale
@@ -0,0 +1,51 @@
+# -*- encoding: utf-8 -*-
+
+# random projection forest against brute force search: recall, build and per-query time
+
+import os
+import tempfile
+import time
+
+import networkx as nx
+import numpy as np
+
+from model import MultiHSD
+from tools import ann
+from tools.hierarchy import get_hierarchical_representation
+
+
+def benchmark(name, vectors, k=10, n_queries=2000, n_trees=16, leaf_size=32):
+    start = time.time()
+    index = ann.RandomProjectionForest(n_trees, leaf_size, seed=0).build(vectors)
+    build_cost = time.time() - start
+
+    path = os.path.join(tempfile.mkdtemp(), "index.npz")
+    index.save(path)
+    index = ann.RandomProjectionForest.load(path)
+
+    rows = np.random.default_rng(0).choice(len(vectors), min(n_queries, len(vectors)), replace=False)
+    start = time.time()
+    index.query(vectors[rows], k, exclude=rows)
+    query_cost = (time.time() - start) / len(rows)
+    start = time.time()
+    index.exact_query(vectors[rows], k, exclude=rows)
+    exact_cost = (time.time() - start) / len(rows)
+    recall = index.recall(vectors[rows], k, exclude=rows)
+    print(f"{name}: n={len(vectors)}, d={vectors.shape[1]}, trees={n_trees}, recall@{k} {recall:.4f}, "
+          f"build {build_cost:.2f}s, query {query_cost * 1e3:.3f}ms, exact {exact_cost * 1e3:.3f}ms")
+
+
+def embeddings(graphName, hop=3, n_scales=20):
+    graph = nx.read_edgelist(f"../../data/graph/{graphName}.edgelist", create_using=nx.Graph, edgetype=float,
+                             data=[('weight', float)])
+    model = MultiHSD(graph, graphName, hop, n_scales, approx="block")
+    model.hierarchy = get_hierarchical_representation(graph, hop)
+    embedding_dict = model.moment_embed()
+    return np.array([embedding_dict[node] for node in model.nodes])
+
+
+if __name__ == '__main__':
+    benchmark("europe", embeddings("europe"))
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((1000, 40))
+    benchmark("clustered", centers[rng.integers(0, 1000, 200000)] + 0.3 * rng.standard_normal((200000, 40)))
@@ -6,6 +6,8 @@ import networkx as nx
 import numpy as np
 import pygsp
 
+from tools import wavelets as wavelet_backend
+
 def precision_test(graph, scale, order):
     G = pygsp.graphs.Graph(nx.adjacency_matrix(graph))
 
@@ -17,7 +19,7 @@ def precision_test(graph, scale, order):
     approx_wavelets = []
     n_node = nx.number_of_nodes(graph)
     for idx in range(n_node):
-        impulse = np.zeros(n_node, dtype=np.float)
+        impulse = np.zeros(n_node, dtype=float)
         impulse[idx] = 1.0
         coeff = pygsp.filters.approximations.cheby_op(G, chebyshev, impulse)
         approx_wavelets.append(coeff)
@@ -37,8 +39,32 @@ def precision_test(graph, scale, order):
 
     print("-" * 80)
 
+# adaptive order: check that the error bound holds against eigen decomposition
+def adaptive_precision_test(graph, scale, tol, damping=None):
+    laplacian = nx.laplacian_matrix(graph).tocsr().astype(float)
+    n_node = nx.number_of_nodes(graph)
+    lmax = wavelet_backend.estimate_lmax(laplacian)
+
+    start = time.time()
+    coeffs, order, error, loss = wavelet_backend.adaptive_chebyshev_coeffs(scale, lmax, tol, damping)
+    error += loss
+    approx_wavelets = wavelet_backend.chebyshev_op(laplacian, coeffs, lmax,
+                                                   wavelet_backend.impulses(n_node, np.arange(n_node))).T
+    cost = time.time() - start
+
+    eigenvalues, eigenvectors = np.linalg.eigh(laplacian.toarray())
+    precise_wavelets = wavelet_backend.heat_kernel_rows(eigenvalues, eigenvectors, scale, np.arange(n_node))
+
+    diff = np.max(np.abs(approx_wavelets - precise_wavelets))
+    print(f"scale: {scale:.3f}, damping: {damping}, order: {order}, "
+          f"error bound: {error:.3e} (damping {loss:.3e}), max diff: {diff:.3e}, time: {cost:.3f}s")
+    # small slack for rounding of the recurrence
+    assert diff <= error + 1e-12 * order, "chebyshev error exceeds its bound"
+
+
 if __name__ == '__main__':
-    g = nx.read_edgelist(f"../../data/graph/cox2.edgelist", create_using=nx.Graph, edgetype=float,
+    g = nx.read_edgelist(f"../../data/graph/europe.edgelist", create_using=nx.Graph, edgetype=float,
                          data=[('weight', float)])
     for scale in np.linspace(0.5, 50, 10):
-        precision_test(g, scale, 50)
+        for damping in [None, "jackson", "lanczos"]:
+            adaptive_precision_test(g, scale, 1e-6, damping)
@@ -0,0 +1,100 @@
+# -*- encoding: utf-8 -*-
+
+# checkpointed jobs resumed by a new process: the first process stops after a few finished tasks,
+# the second one has to open the same job directory, skip those tasks and give the uncheckpointed result.
+# run from the repository root: python -m tests.other_test.checkpoint_check
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import networkx as nx
+import numpy as np
+
+from model.HSD import HSD
+from model.multiscale_HSD import MultiHSD
+from tools import checkpoint
+from tools.hierarchy import get_hierarchical_representation
+
+GraphPath = "data/graph/europe.edgelist"
+Hop = 2
+Scale = 2.0
+
+
+class CheckMultiHSD(MultiHSD):
+
+    # hierarchy built in place instead of read from the hierarchy directory
+    def init(self):
+        self.scales = np.exp(np.linspace(np.log(0.01), np.log(self.get_lmax() * 1.25), self.n_scales))
+        self.hierarchy = get_hierarchical_representation(self.graph, self.hop)
+
+
+# result of a job as one array, checkpointed under checkpoint_dir if given
+def run_job(job: str, checkpoint_dir=None) -> np.ndarray:
+    graph = nx.read_edgelist(GraphPath, nodetype=int)
+    if job == "embed":
+        model = CheckMultiHSD(graph, "europe", Hop, 6, approx="block")
+        embeddings = model.parallel_embed(2, checkpoint_dir=checkpoint_dir)
+        return np.array([embeddings[node] for node in model.nodes])
+    model = HSD(graph, "europe", Scale, Hop, "wasserstein")
+    model.hierarchy = get_hierarchical_representation(graph, Hop)
+    wavelets = model.calculate_wavelets(Scale, "block")
+    return np.asarray(model.parallel_calculate_HSD(2, wavelets=wavelets, checkpoint_dir=checkpoint_dir))
+
+
+# one run in this process, stopped after stop_after finished tasks if it is not negative
+def child(job: str, checkpoint_dir: str, stop_after: int, result_path: str):
+    mark_done = checkpoint.Checkpoint.mark_done
+    computed = []
+
+    def counting_mark_done(store, task):
+        mark_done(store, task)
+        computed.append(task)
+        if len(computed) == stop_after:
+            raise SystemExit(3)
+
+    checkpoint.Checkpoint.mark_done = counting_mark_done
+    result = run_job(job, checkpoint_dir)
+    np.save(result_path, result)
+    print(json.dumps({"computed": len(computed)}))
+
+
+def run_child(job: str, checkpoint_dir: str, stop_after: int, result_path: str) -> (int, dict):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get("PYTHONPATH", "")]))
+    proc = subprocess.run([sys.executable, "-m", "tests.other_test.checkpoint_check", "child", job, checkpoint_dir,
+                           str(stop_after), result_path], env=env, capture_output=True, text=True)
+    lines = [line for line in proc.stdout.splitlines() if line.startswith("{")]
+    return proc.returncode, json.loads(lines[-1]) if lines else None
+
+
+def resume_check(job: str, stop_after=3):
+    reference = run_job(job)
+    checkpoint_dir = tempfile.mkdtemp(prefix="checkpoint_check_")
+    result_path = os.path.join(checkpoint_dir, "result.npy")
+
+    code, _ = run_child(job, checkpoint_dir, stop_after, result_path)
+    assert code == 3, f"first run should stop after {stop_after} tasks, exit code {code}"
+    jobs = [name for name in os.listdir(checkpoint_dir) if os.path.isdir(os.path.join(checkpoint_dir, name))]
+    assert len(jobs) == 1, jobs
+
+    code, report = run_child(job, checkpoint_dir, -1, result_path)
+    assert code == 0, f"second run failed, exit code {code}"
+    resumed = [name for name in os.listdir(checkpoint_dir) if os.path.isdir(os.path.join(checkpoint_dir, name))]
+    assert resumed == jobs, f"second run opened another job directory: {resumed}"
+    with open(os.path.join(checkpoint_dir, jobs[0], "tasks.log"), mode="r", encoding="utf-8") as fin:
+        n_tasks = len([line for line in fin.read().split("\n") if line])
+    assert report["computed"] == n_tasks - stop_after, (report, n_tasks)
+    result = np.load(result_path)
+    assert np.allclose(result, reference, rtol=0.0, atol=1e-12)
+    print(f"{job}: {stop_after} of {n_tasks} tasks done by the first process, {report['computed']} by the second, "
+          f"max diff to the uncheckpointed result {np.max(np.abs(result - reference)):.3e}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "child":
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]), sys.argv[5])
+    else:
+        resume_check("embed")
+        resume_check("distances")
@@ -0,0 +1,31 @@
+# -*- encoding: utf-8 -*-
+
+# batched metrics against the scalar ones, and basic properties of JS
+
+import numpy as np
+
+from tools import metrics
+
+
+def js_check():
+    p, q = np.array([.2, .3, .5]), np.array([.5, .3, .2])
+    expected = 0.5 * np.sum(p * np.log(2 * p / (p + q))) + 0.5 * np.sum(q * np.log(2 * q / (p + q)))
+    assert abs(metrics.JS_divergence(p, p)) < 1e-12
+    assert abs(metrics.JS_divergence(p, q) - expected) < 1e-12
+    assert abs(metrics.batch_distance(p[None, :], p[None, :], 'js')[0]) < 1e-12
+    assert abs(metrics.batch_distance(p[None, :], q[None, :], 'js')[0] - expected) < 1e-12
+
+    rng = np.random.default_rng(0)
+    P, Q = rng.random((200, 8)), rng.random((200, 8))
+    P[rng.random(P.shape) < 0.3] = 0.0
+    P, Q = P / P.sum(axis=1, keepdims=True), Q / Q.sum(axis=1, keepdims=True)
+    batch = metrics.batch_distance(P, Q, 'js')
+    scalar = np.array([metrics.JS_divergence(p, q) for p, q in zip(P, Q)])
+    assert np.all(batch >= -1e-12) and np.all(batch <= np.log(2) + 1e-12)
+    assert np.allclose(batch, scalar, rtol=0.0, atol=1e-12)
+    assert np.allclose(metrics.batch_distance(P, P, 'js'), 0.0, rtol=0.0, atol=1e-12)
+    print(f"js: JS(p, q) = {metrics.JS_divergence(p, q):.6f}, batch max diff {np.max(np.abs(batch - scalar)):.3e}")
+
+
+if __name__ == '__main__':
+    js_check()
@@ -0,0 +1,67 @@
+# -*- encoding: utf-8 -*-
+
+# float32 vs float64 accuracy report on the bundled labeled graphs
+
+import time
+
+import networkx as nx
+import numpy as np
+
+from model import HSD, MultiHSD
+from tools import dataloader, evaluate
+from tools.hierarchy import get_hierarchical_representation
+
+
+def relative_error(approx, exact):
+    exact = np.asarray(exact, dtype=np.float64)
+    diff = np.abs(np.asarray(approx, dtype=np.float64) - exact)
+    return np.max(diff), np.max(diff) / max(np.max(np.abs(exact)), 1e-12)
+
+
+def embed(graph, graphName, hierarchy, hop, n_scales, dtype):
+    model = MultiHSD(graph, graphName, hop, n_scales, approx="block", dtype=dtype)
+    model.hierarchy = hierarchy
+    start = time.time()
+    embedding_dict = model.embed()
+    cost = time.time() - start
+    return np.array([embedding_dict[node] for node in model.nodes]), model.nodes, cost
+
+
+def distance(graph, graphName, hierarchy, hop, scale, dtype):
+    model = HSD(graph, graphName, scale, hop, "wasserstein", dtype=dtype)
+    model.hierarchy = hierarchy
+    start = time.time()
+    dist_mat = model.calculate_structural_distance(scale, approx="block")
+    return dist_mat, time.time() - start
+
+
+def report(graphName, hop=3, n_scales=20, scale=1.0):
+    graph = nx.read_edgelist(f"../../data/graph/{graphName}.edgelist", create_using=nx.Graph, edgetype=float,
+                             data=[('weight', float)])
+    label_dict = dataloader.read_label(f"../../data/label/{graphName}.label")
+    hierarchy = get_hierarchical_representation(graph, hop)
+
+    embeddings64, nodes, cost64 = embed(graph, graphName, hierarchy, hop, n_scales, np.float64)
+    embeddings32, _, cost32 = embed(graph, graphName, hierarchy, hop, n_scales, np.float32)
+    labels = [label_dict[node] for node in nodes]
+    abs_err, rel_err = relative_error(embeddings32, embeddings64)
+    # stratified folds need every class to have at least cv members
+    cv = min(5, min(np.unique(labels, return_counts=True)[1]))
+    knn64, knn32 = float("nan"), float("nan")
+    if cv >= 2:
+        knn64 = evaluate.KNN_evaluate(embeddings64, labels, cv=cv, n_neighbor=min(5, len(labels) // cv))
+        knn32 = evaluate.KNN_evaluate(embeddings32, labels, cv=cv, n_neighbor=min(5, len(labels) // cv))
+    print(f"{graphName} embedding: max abs err {abs_err:.3e}, max rel err {rel_err:.3e}, "
+          f"KNN f64 {knn64:.4f} f32 {knn32:.4f}, time f64 {cost64:.2f}s f32 {cost32:.2f}s, "
+          f"bytes f64 {embeddings64.nbytes} f32 {embeddings64.nbytes // 2}")
+
+    dist64, cost64 = distance(graph, graphName, hierarchy, hop, scale, np.float64)
+    dist32, cost32 = distance(graph, graphName, hierarchy, hop, scale, np.float32)
+    abs_err, rel_err = relative_error(dist32, dist64)
+    print(f"{graphName} HSD distance: max abs err {abs_err:.3e}, max rel err {rel_err:.3e}, "
+          f"dtype {dist32.dtype}, time f64 {cost64:.2f}s f32 {cost32:.2f}s")
+
+
+if __name__ == '__main__':
+    for name in ["mkarate", "barbell", "europe"]:
+        report(name)
@@ -0,0 +1,214 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Approximate nearest neighbour search over node embeddings (MultiHSD, GraphWave).
+A random projection forest: every tree splits its points in half along the difference of two random points,
+a query descends each tree to one leaf, and the union of the leaves is searched exactly.
+More trees give higher recall at a higher query cost, `recall` measures it against brute force.
+"""
+
+import numpy as np
+
+
+class RandomProjectionForest(object):
+
+    def __init__(self, n_trees=16, leaf_size=32, seed=None):
+        """
+        :param n_trees: number of trees, candidates per query are at most n_trees * leaf_size
+        :param leaf_size: largest number of points in a leaf
+        :param seed: seed of the random split directions
+        """
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.seed = seed
+        self.vectors = None
+        self.ids = None
+        # tree nodes of all trees: split normal and threshold, children (left, right),
+        # a negative child -(l + 1) is leaf l, whose points are leaf_items[leaf_offsets[l]: leaf_offsets[l + 1]]
+        self.normals, self.thresholds, self.children = None, None, None
+        self.leaf_offsets, self.leaf_items = None, None
+        self.roots = None
+
+    def build(self, vectors: np.ndarray, ids=None):
+        """
+        :param vectors: (n, d) embeddings
+        :param ids: node of every row, defaults to the row index
+        """
+        self.vectors = np.ascontiguousarray(vectors)
+        n, d = self.vectors.shape
+        self.ids = np.arange(n) if ids is None else np.asarray(ids)
+        rng = np.random.default_rng(self.seed)
+
+        normals, thresholds, children = [], [], []
+        leaves = []
+        roots = []
+        for _ in range(self.n_trees):
+            # (items, parent, side) of nodes to split, side 0 is the left child
+            stack = [(np.arange(n), -1, 0)]
+            while stack:
+                items, parent, side = stack.pop()
+                split = self._split(items, rng) if len(items) > self.leaf_size else None
+                if split is None:
+                    node = -(len(leaves) + 1)
+                    leaves.append(items)
+                else:
+                    normal, threshold, left, right = split
+                    node = len(normals)
+                    normals.append(normal)
+                    thresholds.append(threshold)
+                    children.append([0, 0])
+                    stack.append((left, node, 0))
+                    stack.append((right, node, 1))
+                if parent < 0:
+                    roots.append(node)
+                else:
+                    children[parent][side] = node
+
+        self.normals = np.array(normals, dtype=self.vectors.dtype).reshape((-1, d))
+        self.thresholds = np.array(thresholds, dtype=np.float64)
+        self.children = np.array(children, dtype=np.int64).reshape((-1, 2))
+        self.leaf_offsets = np.concatenate([[0], np.cumsum([len(leaf) for leaf in leaves])]).astype(np.int64)
+        self.leaf_items = np.concatenate(leaves).astype(np.int64)
+        self.roots = np.array(roots, dtype=np.int64)
+        return self
+
+    # hyperplane splitting items near the median projection, ties at the median (e.g. structurally equivalent
+    # nodes with identical embeddings) are cut at the nearest change of projection instead,
+    # and items that all project to the same value are halved by position, so no leaf exceeds leaf_size
+    def _split(self, items, rng):
+        a, b = self.vectors[rng.choice(items, 2, replace=False)]
+        normal = a - b
+        if not np.any(normal):
+            normal = rng.standard_normal(self.vectors.shape[1]).astype(self.vectors.dtype)
+        projections = self.vectors[items] @ normal
+        order = np.argsort(projections, kind="stable")
+        ranked = projections[order]
+        half = len(items) // 2
+        if ranked[half - 1] == ranked[half]:
+            cuts = [int(np.searchsorted(ranked, ranked[half], side=side)) for side in ["left", "right"]]
+            cuts = [cut for cut in cuts if 0 < cut < len(items)]
+            if cuts:
+                half = min(cuts, key=lambda cut: abs(cut - half))
+            else:
+                # queries on the threshold descend to the left half, whose items are as near as the right ones
+                return normal, float(ranked[half]), items[order[:half]], items[order[half:]]
+        return normal, (ranked[half - 1] + ranked[half]) / 2.0, items[order[:half]], items[order[half:]]
+
+    def leaves_of(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Leaf of every query in every tree, (n_queries, n_trees).
+        """
+        queries = np.atleast_2d(queries)
+        leaves = np.empty((len(queries), len(self.roots)), dtype=np.int64)
+        for t, root in enumerate(self.roots):
+            node = np.full(len(queries), root, dtype=np.int64)
+            active = node >= 0
+            while np.any(active):
+                current = node[active]
+                right = np.einsum("ij,ij->i", queries[active], self.normals[current]) > self.thresholds[current]
+                node[active] = self.children[current, right.astype(np.int64)]
+                active = node >= 0
+            leaves[:, t] = -node - 1
+        return leaves
+
+    def query(self, queries: np.ndarray, k=10, exclude=None, block_rows=256) -> (np.ndarray, np.ndarray):
+        """
+        Approximate k nearest rows of every query by euclidean distance, in blocks of queries.
+        :param queries: (n_queries, d), or one vector
+        :param exclude: row of every query to leave out, e.g. its own row when querying indexed nodes
+        :return: ids and distances, (n_queries, k), nearest first, padded with inf distances if too few candidates
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=self.vectors.dtype))
+        ids, dists = [], []
+        for start in range(0, len(queries), block_rows):
+            block = queries[start:start + block_rows]
+            candidates = self._candidates(self.leaves_of(block))
+            diff = self.vectors[np.maximum(candidates, 0)] - block[:, None, :]
+            block_dists = np.sqrt(np.einsum("qcd,qcd->qc", diff, diff))
+            block_dists[candidates < 0] = np.inf
+            if exclude is not None:
+                block_dists[candidates == np.asarray(exclude)[start:start + block_rows, None]] = np.inf
+            block_ids, block_dists = self._top_k(np.maximum(candidates, 0), block_dists, k)
+            ids.append(block_ids)
+            dists.append(block_dists)
+        return np.concatenate(ids), np.concatenate(dists)
+
+    # rows in the leaves of every query, -1 for padding and for points already found in another tree
+    def _candidates(self, leaves: np.ndarray) -> np.ndarray:
+        starts, ends = self.leaf_offsets[leaves], self.leaf_offsets[leaves + 1]
+        width = int((ends - starts).max(initial=0))
+        position = np.arange(width)[None, None, :]
+        valid = position < (ends - starts)[:, :, None]
+        items = self.leaf_items[np.minimum(starts[:, :, None] + position, len(self.leaf_items) - 1)]
+        candidates = np.sort(np.where(valid, items, -1).reshape((len(leaves), -1)), axis=1)
+        candidates[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = -1
+        return candidates
+
+    # the k smallest distances of every row, nearest first
+    def _top_k(self, candidates, dists, k):
+        if dists.shape[1] < k:
+            pad = k - dists.shape[1]
+            dists = np.pad(dists, ((0, 0), (0, pad)), constant_values=np.inf)
+            candidates = np.pad(candidates, ((0, 0), (0, pad)), constant_values=0)
+        keep = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        dists = np.take_along_axis(dists, keep, axis=1)
+        candidates = np.take_along_axis(candidates, keep, axis=1)
+        order = np.argsort(dists, axis=1, kind="stable")
+        return self.ids[np.take_along_axis(candidates, order, axis=1)], np.take_along_axis(dists, order, axis=1)
+
+    def exact_query(self, queries: np.ndarray, k=10, exclude=None, block_rows=1024) -> (np.ndarray, np.ndarray):
+        """
+        Brute force counterpart of `query`, in blocks of queries.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=self.vectors.dtype))
+        squared = np.einsum("ij,ij->i", self.vectors, self.vectors)
+        ids, dists = [], []
+        for start in range(0, len(queries), block_rows):
+            block = queries[start:start + block_rows]
+            d2 = squared[None, :] - 2.0 * block @ self.vectors.T + np.einsum("ij,ij->i", block, block)[:, None]
+            block_dists = np.sqrt(np.maximum(d2, 0.0))
+            if exclude is not None:
+                block_dists[np.arange(len(block)), np.asarray(exclude)[start:start + block_rows]] = np.inf
+            block_ids, block_dists = self._top_k(np.broadcast_to(np.arange(len(self.vectors)), block_dists.shape),
+                                                 block_dists, k)
+            ids.append(block_ids)
+            dists.append(block_dists)
+        return np.concatenate(ids), np.concatenate(dists)
+
+    def recall(self, queries: np.ndarray, k=10, exclude=None) -> float:
+        """
+        Mean fraction of the exact k nearest neighbours found by `query`, ties at the k-th distance count as found.
+        """
+        _, approx_dists = self.query(queries, k, exclude)
+        _, exact_dists = self.exact_query(queries, k, exclude)
+        kth = exact_dists[:, -1:]
+        found = np.sum(approx_dists <= kth * (1 + 1e-9) + 1e-12, axis=1)
+        return float(np.mean(np.minimum(found, np.sum(np.isfinite(exact_dists), axis=1))
+                             / np.maximum(np.sum(np.isfinite(exact_dists), axis=1), 1)))
+
+    def save(self, path: str):
+        """
+        Save the index into a .npz file, ids are stored as strings unless they are integers.
+        """
+        ids = self.ids if np.issubdtype(self.ids.dtype, np.integer) else self.ids.astype(str)
+        np.savez(path, vectors=self.vectors, ids=ids, normals=self.normals, thresholds=self.thresholds,
+                 children=self.children, leaf_offsets=self.leaf_offsets, leaf_items=self.leaf_items,
+                 roots=self.roots, params=np.array([self.n_trees, self.leaf_size]))
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            n_trees, leaf_size = data["params"]
+            index = cls(int(n_trees), int(leaf_size))
+            for name in ["vectors", "ids", "normals", "thresholds", "children", "leaf_offsets", "leaf_items", "roots"]:
+                setattr(index, name, data[name])
+        return index
+
+
+def build_index(embedding_dict: dict, n_trees=16, leaf_size=32, seed=None) -> RandomProjectionForest:
+    """
+    Index of the {node: vector} dict returned by MultiHSD.embed / parallel_embed and GraphWave.embed.
+    """
+    nodes = list(embedding_dict.keys())
+    vectors = np.array([embedding_dict[node] for node in nodes])
+    return RandomProjectionForest(n_trees, leaf_size, seed).build(vectors, nodes)
@@ -0,0 +1,137 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Checkpoints of long running jobs, e.g. HSD.parallel_calculate_HSD and MultiHSD.parallel_embed.
+A job lives in a directory named by the hash of its parameters (graph hash, hop, metric, scales, ...):
+manifest.json holds the parameters and the task split, tasks.log is an append-only log of finished tasks,
+and the arrays they produced sit next to them as .npy or memmap files.
+Running the same job again opens the same directory and skips the logged tasks.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from tools import scratch
+
+
+def job_key(params: dict) -> str:
+    """
+    Hash of job parameters, which must be json serializable.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def array_digest(*arrays) -> str:
+    """
+    Content hash of arrays, for inputs that are not described by a few parameters, e.g. profiles.
+    """
+    sha = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        sha.update(arr.dtype.str.encode("utf-8"))
+        sha.update(str(arr.shape).encode("utf-8"))
+        sha.update(arr.tobytes())
+    return sha.hexdigest()
+
+
+class Checkpoint(object):
+
+    def __init__(self, root: str, params: dict):
+        """
+        Open the checkpoint of a job, created if it doesn't exist yet.
+        :param root: directory of all checkpoints
+        :param params: parameters that decide the result of the job, json serializable
+        """
+        self.directory = os.path.join(root, job_key(params))
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+        self.log_path = os.path.join(self.directory, "tasks.log")
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, mode="r", encoding="utf-8") as fin:
+                self.manifest = json.load(fin)
+        else:
+            self.manifest = {"params": params}
+            self._write_manifest()
+        self.done = self._read_log()
+
+    def _write_manifest(self):
+        # write then rename, a crash never leaves a partial manifest
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="w", encoding="utf-8") as fout:
+            json.dump(self.manifest, fout, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    # finished tasks, a line torn by a crash is ignored and terminated so that later entries start on a new line
+    def _read_log(self) -> set:
+        done = set()
+        if os.path.exists(self.log_path):
+            with open(self.log_path, mode="r", encoding="utf-8") as fin:
+                lines = fin.read().split("\n")
+            for line in lines:
+                try:
+                    done.add(json.loads(line))
+                except ValueError:
+                    continue
+            if lines[-1] != "":
+                with open(self.log_path, mode="a", encoding="utf-8") as fout:
+                    fout.write("\n")
+        return done
+
+    def setdefault(self, key: str, value):
+        """
+        Value stored in the manifest under key, value is stored if there is none yet,
+        e.g. the task split, so that a resumed job keeps the split of the first run.
+        """
+        if key not in self.manifest:
+            self.manifest[key] = value
+            self._write_manifest()
+        return self.manifest[key]
+
+    def is_done(self, task) -> bool:
+        return task in self.done
+
+    def mark_done(self, task):
+        """
+        Log a finished task, its outputs must be on disk before.
+        :param task: str or int
+        """
+        with open(self.log_path, mode="a", encoding="utf-8") as fout:
+            fout.write(json.dumps(task) + "\n")
+            fout.flush()
+            os.fsync(fout.fileno())
+        self.done.add(task)
+
+    def memmap(self, name: str, shape, dtype) -> np.memmap:
+        """
+        Output array filled by the tasks in place, zeros when created, opened as it is when resumed.
+        """
+        path = os.path.join(self.directory, f"{name}.dat")
+        if os.path.exists(path):
+            return scratch.open_memmap(path, shape, dtype, mode="r+")
+        return np.memmap(path, dtype=dtype, mode="w+", shape=tuple(shape))
+
+    def save(self, name: str, arr: np.ndarray):
+        """
+        Output of a single task, written atomically.
+        """
+        path = os.path.join(self.directory, f"{name}.npy")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="wb") as fout:
+            np.save(fout, np.asarray(arr))
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_path, path)
+
+    def load(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.directory, f"{name}.npy"))
+
+    def clear(self):
+        """
+        Delete the checkpoint, e.g. once its result has been saved elsewhere.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.done = set()
@@ -0,0 +1,102 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Condensed distance matrices.
+A symmetric n x n distance matrix with zero diagonal is stored as the 1-D vector of its upper triangle,
+in the layout of scipy.spatial.distance.squareform: d(i, j), i < j, is at row_start(n, i) + j - i - 1.
+Helpers here accept either layout, so producers and consumers don't have to care which one they get.
+"""
+
+import numpy as np
+
+
+def condensed_size(n: int) -> int:
+    """
+    Length of the condensed vector of n nodes.
+    """
+    return n * (n - 1) // 2
+
+
+def condensed_n(cond) -> int:
+    """
+    Number of nodes of a condensed vector, inverse of `condensed_size`.
+    """
+    m = len(cond)
+    n = int((1 + np.sqrt(1 + 8 * m)) // 2)
+    if condensed_size(n) != m:
+        raise ValueError(f"{m} is not the length of a condensed distance matrix")
+    return n
+
+
+def n_nodes(mat) -> int:
+    """
+    Number of nodes of a square or condensed distance matrix.
+    """
+    return condensed_n(mat) if mat.ndim == 1 else mat.shape[0]
+
+
+def row_start(n: int, i):
+    """
+    Position of d(i, i + 1) in the condensed vector, i may be an array.
+    """
+    return i * n - i * (i + 1) // 2
+
+
+def upper_row(mat, i: int) -> np.ndarray:
+    """
+    View of d(i, j) for every j > i, writable if mat is.
+    """
+    if mat.ndim == 2:
+        return mat[i, i + 1:]
+    n = condensed_n(mat)
+    start = row_start(n, i)
+    return mat[start:start + n - i - 1]
+
+
+def upper_block(mat, start: int, end: int) -> (np.ndarray, np.ndarray):
+    """
+    Upper triangle values of rows [start, end) in row-major order, as float64,
+    with their flat indices i * n + j in the square matrix.
+    """
+    n = n_nodes(mat)
+    if mat.ndim == 2:
+        upper = np.arange(n)[None, :] > np.arange(start, end)[:, None]
+        values = np.asarray(mat[start:end], dtype=np.float64)[upper]
+        return values, np.flatnonzero(upper) + start * n
+    values = np.asarray(mat[row_start(n, start):row_start(n, end)], dtype=np.float64)
+    rows = np.repeat(np.arange(start, end), n - 1 - np.arange(start, end))
+    cols = np.arange(len(values)) - (row_start(n, rows) - row_start(n, start)) + rows + 1
+    return values, rows * n + cols
+
+
+def read_rows(mat, rows) -> np.ndarray:
+    """
+    Full rows of the square matrix, (len(rows), n), for either layout.
+    """
+    rows = np.asarray(rows)
+    if mat.ndim == 2:
+        return np.asarray(mat[rows])
+    n = condensed_n(mat)
+    if n < 2:
+        return np.zeros((len(rows), n), dtype=mat.dtype)
+    cols = np.arange(n)
+    i, j = np.minimum(rows[:, None], cols[None, :]), np.maximum(rows[:, None], cols[None, :])
+    index = row_start(n, i) + j - i - 1
+    diagonal = i == j
+    block = np.asarray(mat[np.where(diagonal, 0, index)])
+    block[diagonal] = 0
+    return block
+
+
+def to_condensed(mat: np.ndarray) -> np.ndarray:
+    """
+    Condensed vector of a square matrix, same as squareform(mat, checks=False).
+    """
+    return np.asarray(mat)[np.triu_indices(mat.shape[0], 1)]
+
+
+def to_square(cond: np.ndarray) -> np.ndarray:
+    """
+    Square matrix of a condensed vector, same as squareform(cond).
+    """
+    return read_rows(cond, np.arange(condensed_n(cond)))
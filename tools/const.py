@@ -1,5 +1,6 @@
 # -*- encoding: utf-8 -*-
 
+import os
 import platform
 
 PAGERANK = "PageRank"
@@ -16,3 +17,7 @@ CLASS_INFO = {
     "mkarate": 34,
     "barbell": 8,
 }
+
+# eigen decompositions of laplacians are cached here, see tools/spectral_cache.py
+SpectralCacheDir = os.environ.get("HSD_SPECTRAL_CACHE",
+                                  os.path.join(os.path.expanduser("~"), ".cache", "HSD", "spectral"))
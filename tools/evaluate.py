@@ -7,6 +7,7 @@ Evluate the performance of embedding via different methods.
 import math
 
 import numpy as np
+from scipy import sparse
 from sklearn import metrics
 from sklearn import utils as sktools
 from sklearn.cluster import AgglomerativeClustering
@@ -14,9 +15,13 @@ from sklearn.cluster import SpectralClustering
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import accuracy_score, classification_report, balanced_accuracy_score, f1_score, precision_score, \
     recall_score
-from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import StratifiedKFold, cross_val_score
 from sklearn.neighbors import KNeighborsClassifier
 
+from tools import condensed
+from tools import knn
+from tools import scratch
+
 def cluster_evaluate(embeddings, labels, n_class, metric="euclidean"):
     """
         Unsupervised setting: We assess the ability of each method to embed close together nodes
@@ -58,10 +63,17 @@ def LR_evaluate(data, labels, cv=5):
     return np.mean(test_scores)
 
 
-def KNN_evaluate(data, labels, metric="minkowski", cv=5, n_neighbor=10):
+def KNN_evaluate(data, labels, metric="minkowski", cv=5, n_neighbor=10, block_rows=None):
     """
     基于节点的相似度进行KNN分类，在嵌入之前进行，为了验证通过层次化相似度的优良特性。
+    metric="precomputed"时data为距离矩阵（内存中的方阵、np.memmap或压缩的上三角向量），统一按行块读取，见precomputed_KNN_evaluate，
+    行和列按同一个顺序打乱；或者是HSD.calculate_structural_neighbors得到的稀疏kNN图，见neighbor_graph_KNN_evaluate。
     """
+    if metric == "precomputed" and sparse.issparse(data):
+        return neighbor_graph_KNN_evaluate(data, labels, cv, n_neighbor)
+    if metric == "precomputed":
+        data = data if isinstance(data, np.ndarray) else np.asarray(data)
+        return precomputed_KNN_evaluate(data, labels, cv, n_neighbor, block_rows or 1024)
     data, labels = sktools.shuffle(data, labels)
     knn = KNeighborsClassifier(weights='uniform', algorithm="auto", n_neighbors=n_neighbor, metric=metric, p=2)
     test_scores = cross_val_score(knn, data, y=labels, cv=cv, scoring="accuracy")
@@ -69,6 +81,59 @@ def KNN_evaluate(data, labels, metric="minkowski", cv=5, n_neighbor=10):
     return np.mean(test_scores)
 
 
+def precomputed_KNN_evaluate(dist_mat, labels, cv=5, n_neighbor=10, block_rows=1024):
+    """
+    KNN classification on a precomputed distance matrix, read in row blocks of test nodes,
+    so that a memory-mapped matrix is never loaded as a whole. dist_mat may also be a condensed vector, see tools.condensed.
+    Same as KNN_evaluate: shuffled nodes, stratified folds, uniform votes, ties go to the smallest label.
+    """
+    n = len(labels)
+    classes, y = np.unique(np.asarray(labels), return_inverse=True)
+    perm = sktools.shuffle(np.arange(n))
+    test_scores = []
+    for train, test in StratifiedKFold(n_splits=cv).split(np.zeros(n), y[perm]):
+        train, test = perm[train], np.sort(perm[test])
+        correct = 0
+        for start in range(0, len(test), block_rows):
+            rows = test[start:start + block_rows]
+            dists = condensed.read_rows(dist_mat, rows)[:, train]
+            nearest = np.argpartition(dists, n_neighbor - 1, axis=1)[:, :n_neighbor]
+            votes = np.zeros((len(rows), len(classes)), dtype=np.int64)
+            np.add.at(votes, (np.arange(len(rows))[:, None], y[train][nearest]), 1)
+            correct += np.sum(np.argmax(votes, axis=1) == y[rows])
+            scratch.drop_pages(dist_mat)
+        test_scores.append(correct / len(test))
+    print(f"KNN: tests scores:{np.array(test_scores)}, mean_score={np.mean(test_scores)}\n")
+    return np.mean(test_scores)
+
+
+def neighbor_graph_KNN_evaluate(graph, labels, cv=5, n_neighbor=10):
+    """
+    Same as precomputed_KNN_evaluate, but on a sparse kNN graph (see HSD.calculate_structural_neighbors):
+    a test node votes with its stored neighbours that are in the training fold, nearest first.
+    Build the graph with k well above n_neighbor, e.g. n_neighbor * cv / (cv - 1), so that enough of them are left.
+    """
+    graph = sparse.csr_matrix(graph)
+    n = len(labels)
+    classes, y = np.unique(np.asarray(labels), return_inverse=True)
+    perm = sktools.shuffle(np.arange(n))
+    test_scores = []
+    for train, test in StratifiedKFold(n_splits=cv).split(np.zeros(n), y[perm]):
+        train, test = perm[train], np.sort(perm[test])
+        in_train = np.zeros(n, dtype=bool)
+        in_train[train] = True
+        dists, index = knn.padded_neighbors(graph, test)
+        dists = np.where((index >= 0) & in_train[index], dists, np.inf)
+        order = np.argsort(dists, axis=1, kind="stable")[:, :n_neighbor]
+        nearest = np.take_along_axis(index, order, axis=1)
+        valid = np.isfinite(np.take_along_axis(dists, order, axis=1))
+        votes = np.zeros((len(test), len(classes)), dtype=np.int64)
+        np.add.at(votes, (np.nonzero(valid)[0], y[nearest[valid]]), 1)
+        test_scores.append(np.sum(np.argmax(votes, axis=1) == y[test]) / len(test))
+    print(f"KNN: tests scores:{np.array(test_scores)}, mean_score={np.mean(test_scores)}\n")
+    return np.mean(test_scores)
+
+
 def evalute_results(labels: list, preds: list):
     accuracy = accuracy_score(labels, preds)
     balanced_accuracy = balanced_accuracy_score(labels, preds)
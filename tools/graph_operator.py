@@ -0,0 +1,89 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Graph operators shared by HSD, MultiHSD and GraphWave.
+A GraphOperator is built once per graph, then reused across scales, calls and worker processes,
+instead of every model (and every approx call) rebuilding its matrices and lmax estimate.
+"""
+
+import time
+
+import networkx as nx
+import numpy as np
+import pygsp
+from scipy import sparse
+
+from tools import util
+from tools import wavelets as wavelet_backend
+
+
+class GraphOperator(object):
+
+    def __init__(self, graph: nx.Graph, dtype=np.float64):
+        """
+        :param graph: nx.Graph
+        :param dtype: float type of adjacency and laplacian
+        """
+        self.dtype = np.dtype(dtype)
+        self.timings = dict()
+        self.counts = dict()
+
+        start = time.time()
+        self.nodes = list(nx.nodes(graph))
+        self.n_node = len(self.nodes)
+        self.idx2node, self.node2idx = util.build_node_idx_map(graph)
+        self._record("index", start)
+
+        start = time.time()
+        self.adjacency = sparse.csr_matrix(nx.adjacency_matrix(graph), dtype=self.dtype)
+        self.degrees = np.asarray(self.adjacency.sum(axis=1)).reshape(-1)
+        # combinatorial laplacian D - A, same as nx.laplacian_matrix
+        self.laplacian = sparse.csr_matrix(sparse.diags(self.degrees) - self.adjacency, dtype=self.dtype)
+        self._record("laplacian", start)
+
+        self.lmax = None
+        self.pygsp_graph = None
+
+    # accumulate the cost of a setup step
+    def _record(self, step: str, start: float):
+        self.timings[step] = self.timings.get(step, 0.0) + time.time() - start
+        self.counts[step] = self.counts.get(step, 0) + 1
+
+    # largest eigenvalue of laplacian, estimated once
+    def get_lmax(self) -> float:
+        if self.lmax is None:
+            start = time.time()
+            self.lmax = wavelet_backend.estimate_lmax(self.laplacian)
+            self._record("lmax", start)
+        return self.lmax
+
+    # pygsp graph built from the sparse adjacency, sharing the lmax estimate
+    def get_pygsp_graph(self) -> pygsp.graphs.Graph:
+        if self.pygsp_graph is None:
+            lmax = self.get_lmax()
+            start = time.time()
+            self.pygsp_graph = pygsp.graphs.Graph(self.adjacency)
+            self.pygsp_graph._lmax = lmax
+            self._record("pygsp", start)
+        return self.pygsp_graph
+
+    # heat wavelets of the given rows by pygsp's chebyshev filtering, with the order and damping
+    # of the block backend (see tools.wavelets.ChebyshevSeries), shape (len(rows), n)
+    def pygsp_heat_rows(self, scale, order, damping, rows, dtype=float) -> np.ndarray:
+        G = self.get_pygsp_graph()
+        heat_filter = pygsp.filters.Heat(G, tau=[scale * G._lmax])
+        chebyshev = pygsp.filters.approximations.compute_cheby_coeff(heat_filter, m=order)
+        # g_0 = 1, so pygsp's halving of the first coefficient is unaffected
+        chebyshev = chebyshev * wavelet_backend.chebyshev_damping(order, damping)
+        coeffs = pygsp.filters.approximations.cheby_op(G, chebyshev, wavelet_backend.impulses(self.n_node, rows))
+        return np.transpose(coeffs).astype(dtype, copy=False)
+
+    # setup steps and their total cost in seconds, e.g. {'laplacian': (1, 0.02), 'lmax': (1, 0.1)}
+    def stats(self) -> dict:
+        return {step: (self.counts[step], self.timings[step]) for step in self.timings}
+
+    # the pygsp graph is rebuilt lazily in worker processes instead of being pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pygsp_graph"] = None
+        return state
@@ -8,6 +8,7 @@ PRD：对图的层级划分不应该内嵌到具体的模型中，而是抽象
 import os
 import platform
 import networkx as nx
+import numpy as np
 from tqdm import tqdm
 
 from tools import const
@@ -99,6 +100,26 @@ def read_hierarchy(file_path: str, maxHop: int) -> dict:
     return hierarchy
 
 
+def hierarchy_to_rings(hierarchy: dict, nodes: list, node2idx: dict, maxHop: int) -> (np.ndarray, np.ndarray):
+    """
+    Flatten the hierarchy into CSR-like index arrays, so that numpy code can walk it.
+    The hop-h ring of nodes[i] is members[offsets[r]: offsets[r + 1]], with r = i * (maxHop + 1) + h.
+    Empty placeholders ('') of hierarchy files are dropped.
+    :return: members, offsets
+    """
+    n_layers = maxHop + 1
+    members = []
+    offsets = np.zeros(len(nodes) * n_layers + 1, dtype=np.int64)
+    for idx, node in enumerate(nodes):
+        layers = hierarchy[node]
+        for hop in range(n_layers):
+            level = layers[hop] if hop < len(layers) else []
+            ring = [node2idx[neighbor] for neighbor in level if neighbor != '']
+            members.extend(ring)
+            offsets[idx * n_layers + hop + 1] = len(ring)
+    return np.asarray(members, dtype=np.int64), np.cumsum(offsets)
+
+
 if __name__ == '__main__':
     graph = "zxr_2"
     G = nx.read_edgelist(f"../data/graph/{graph}.edgelist", create_using=nx.Graph,
@@ -0,0 +1,93 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Streaming k nearest structural neighbours.
+Distances are produced in row tiles of the upper triangle and merged into a bounded neighbour list per node,
+so memory is O(n * k + tile) instead of the O(n^2) of a full distance matrix.
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+class NeighborHeap(object):
+
+    def __init__(self, n: int, k: int):
+        """
+        The k smallest distances seen so far of every node, unused slots hold inf and index -1.
+        :param n: number of nodes
+        :param k: neighbours kept per node, at most n - 1 are ever filled
+        """
+        self.n = n
+        self.k = k
+        self.dists = np.full((n, k), np.inf)
+        self.index = np.full((n, k), -1, dtype=np.int64)
+
+    def push_rows(self, rows: np.ndarray, dists: np.ndarray, index: np.ndarray):
+        """
+        Merge candidate neighbours into the lists of rows.
+        :param rows: node indices, (r, )
+        :param dists: candidate distances, (r, m), inf for no candidate
+        :param index: candidate neighbour indices, broadcastable to (r, m)
+        """
+        merged_dists = np.concatenate([self.dists[rows], dists], axis=1)
+        merged_index = np.concatenate([self.index[rows], np.broadcast_to(index, dists.shape)], axis=1)
+        keep = np.argpartition(merged_dists, self.k - 1, axis=1)[:, :self.k]
+        self.dists[rows] = np.take_along_axis(merged_dists, keep, axis=1)
+        self.index[rows] = np.take_along_axis(merged_index, keep, axis=1)
+
+    def push_upper_tile(self, start: int, tile: np.ndarray):
+        """
+        Merge a tile of the upper triangle, both ways since distances are symmetric.
+        :param start: first row of the tile
+        :param tile: (b, n), tile[r, j] = d(start + r, j) for j > start + r, other entries are ignored
+        """
+        end = start + len(tile)
+        rows = np.arange(start, end)
+        upper = np.where(np.arange(self.n)[None, :] > rows[:, None], tile, np.inf)
+        self.push_rows(rows, upper, np.arange(self.n)[None, :])
+        if start + 1 < self.n:
+            self.push_rows(np.arange(start + 1, self.n), upper[:, start + 1:].T, rows[None, :])
+
+    def sorted(self) -> (np.ndarray, np.ndarray):
+        """
+        Neighbour distances and indices of every node, nearest first.
+        """
+        order = np.argsort(self.dists, axis=1, kind="stable")
+        return np.take_along_axis(self.dists, order, axis=1), np.take_along_axis(self.index, order, axis=1)
+
+    def to_csr(self) -> sparse.csr_matrix:
+        """
+        kNN graph as an (n, n) CSR matrix of distances, nearest first in every row.
+        Zero distances are stored explicitly, so every neighbour is an entry.
+        """
+        dists, index = self.sorted()
+        valid = index >= 0
+        indptr = np.concatenate([[0], np.cumsum(valid.sum(axis=1))])
+        return sparse.csr_matrix((dists[valid], index[valid], indptr), shape=(self.n, self.n))
+
+    def to_edgelist(self, nodes: list) -> list:
+        """
+        kNN graph as (node, neighbour, distance) edges, the format of rw.save_edgelist and save_distance_edgelist.
+        """
+        dists, index = self.sorted()
+        return [(nodes[i], nodes[j], float(d)) for i in range(self.n)
+                for j, d in zip(index[i], dists[i]) if j >= 0]
+
+
+def padded_neighbors(graph: sparse.csr_matrix, rows: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Stored neighbours of rows in a kNN graph, padded with inf distances and index -1.
+    :return: distances and indices, (len(rows), max neighbours of rows)
+    """
+    starts, ends = graph.indptr[rows], graph.indptr[rows + 1]
+    lengths = ends - starts
+    width = max(int(lengths.max(initial=0)), 1)
+    dists = np.full((len(rows), width), np.inf)
+    index = np.full((len(rows), width), -1, dtype=np.int64)
+    position = np.arange(width)[None, :]
+    valid = position < lengths[:, None]
+    source = (starts[:, None] + position)[valid]
+    dists[valid] = graph.data[source]
+    index[valid] = graph.indices[source]
+    return dists, index
@@ -15,6 +15,8 @@ import math
 import numpy as np
 from scipy import stats
 
+from tools import condensed
+
 def align_probablity_distribution(p, q, normalized=False):
     """
     为了突出节点度数, 用 0 将两个分布对齐。
@@ -36,6 +38,21 @@ def align_probablity_distribution(p, q, normalized=False):
     return p, q
 
 
+def align_sorted_distribution(p: np.ndarray, q: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    与align_probablity_distribution结果相同，但p，q已经排好序，0直接插入到相应位置，不再排序。
+    """
+    length = max(len(p), len(q))
+    return _insert_zeros(p, length - len(p)), _insert_zeros(q, length - len(q))
+
+
+def _insert_zeros(p: np.ndarray, n_zeros: int) -> np.ndarray:
+    if n_zeros == 0:
+        return np.asarray(p, dtype=np.float64)
+    position = np.searchsorted(p, 0.0)
+    return np.concatenate([p[:position], np.zeros(n_zeros), p[position:]])
+
+
 def check_probablity_distribution(p, q):
     """
     check probablity distribution.
@@ -98,9 +115,13 @@ def JS_divergence(p, q):
     :return: The JS divergence between p, q
     """
     check_probablity_distribution(p, q)
-    m = p + q
-    js = (KL_divergence(p, m, False) + KL_divergence(q, m, False)) / 2.0
-    return js
+    p, q = np.asarray(p, dtype=float), np.asarray(q, dtype=float)
+    m = (p + q) / 2.0
+    # 0 * log(0 / m) = 0, m > 0 wherever p > 0 or q > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kl_pm = np.sum(np.where(p > 0, p * np.log(p / m), 0.0))
+        kl_qm = np.sum(np.where(q > 0, q * np.log(q / m), 0.0))
+    return (kl_pm + kl_qm) / 2.0
 
 
 def L_distance(p, q, order):
@@ -148,12 +169,84 @@ def Dynamic_Time_Warping(p, q):
     raise NotImplementedError("Dynamic_Time_Warping is not implemented yet.")
 
 
-def calculate_distance(p, q, metric):
+def sorted_distributions(distributions: list) -> (np.ndarray, np.ndarray):
+    """
+    把一组一维经验分布各自排序后首尾相接，得到 (values, offsets)，第i个分布为 values[offsets[i]: offsets[i + 1]]。
+    空分布按单个0处理，与用0对齐的做法一致。
+    """
+    distributions = [np.sort(np.asarray(d, dtype=np.float64)) if len(d) > 0 else np.zeros(1)
+                     for d in distributions]
+    offsets = np.zeros(len(distributions) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(d) for d in distributions])
+    values = np.concatenate(distributions) if distributions else np.zeros(0)
+    return values, offsets
+
+
+def wasserstein_upper(values: np.ndarray, offsets: np.ndarray, out: np.ndarray, rows=None, first_row=0):
+    """
+    Accumulate the 1-D Wasserstein distance W1(i, j) of every j > i into out[i, j], equal to
+    scipy.stats.wasserstein_distance on the unsorted distributions, lengths may differ.
+    With CDFs F_i, F_j: W1 = ∫|F_i - F_j| = mean_j - mean_i + 2∫(F_j - F_i)^+.
+    On the gap after the t-th value of a sorted distribution j (length k), F_j is the constant t / k,
+    and F_i < t / k left of the quantile x* of i, so each gap only needs the CDF integral of i
+    at the gap start and at min(gap end, x*). All j > i are handled at once, per row the cost is
+    linear in the total length of distributions.
+    :param values: sorted distributions, see `sorted_distributions`
+    :param offsets: distribution i is values[offsets[i]: offsets[i + 1]]
+    :param out: (n, n) matrix, only the upper triangle is written, or its condensed vector (see `tools.condensed`)
+    :param rows: rows i to compute, all by default
+    :param first_row: a 2-D out may be a tile holding rows first_row, first_row + 1, ... of the matrix
+    """
+    n = len(offsets) - 1
+    lengths = np.diff(offsets)
+    means = np.add.reduceat(values, offsets[:-1]) / lengths
+    # for every value: its column length k, rank t (1-based) in its distribution, and the next value (gap end)
+    columns = np.repeat(np.arange(n), lengths)
+    ranks = np.arange(len(values)) - offsets[columns] + 1
+    ks = lengths[columns]
+    fractions = ranks / ks
+    uppers = np.append(values[1:], np.inf)
+    uppers[offsets[1:] - 1] = np.inf
+    # counting values of i below each value is a merge against the globally sorted values
+    order = np.argsort(values, kind="stable")
+    sorted_values = values[order]
+    positions = np.empty(len(values), dtype=np.int64)
+    positions[order] = np.arange(len(values))
+
+    for i in (range(n) if rows is None else rows):
+        if i + 1 >= n:
+            continue
+        u = values[offsets[i]:offsets[i + 1]]
+        m = len(u)
+        prefix = np.concatenate([[0.0], np.cumsum(u)])
+        # counts[p] = #{u <= sorted_values[p]}
+        counts = np.cumsum(np.bincount(np.searchsorted(sorted_values, u, side="left"), minlength=len(values)))
+        begin = offsets[i + 1]
+        lo, hi, t, k = values[begin:], uppers[begin:], ranks[begin:], ks[begin:]
+        count_lo = counts[positions[begin:]]
+        count_hi = np.append(count_lo[1:], m)
+        # F_i(x) < t / k for x < u[ceil(t * m / k) - 1]
+        star = (t * m + k - 1) // k - 1
+        x_star = u[star]
+        count_star = np.searchsorted(u, u, side="right")[star]
+        y = np.clip(x_star, lo, hi)
+        count_y = np.where(x_star >= hi, count_hi, count_star)
+        # ∫_{lo}^{y} (t / k - F_i), with ∫_{-inf}^{x} F_i = (#{u <= x} * x - sum{u <= x}) / m
+        integral = ((count_y * y - prefix[count_y]) - (count_lo * lo - prefix[count_lo])) / m
+        positive = fractions[begin:] * (y - lo) - integral
+        positive = np.where(x_star > lo, positive, 0.0)
+        positive = np.add.reduceat(positive, offsets[i + 1:-1] - begin)
+        row = condensed.upper_row(out, i) if out.ndim == 1 else out[i - first_row, i + 1:]
+        row += means[i + 1:] - means[i] + 2.0 * positive
+
+
+def calculate_distance(p, q, metric, presorted=False):
     """
     calculate distance between probabilities (p ,q)
     :param p:
     :param q:
     :param metric: str
+    :param presorted: p, q are sorted ndarrays, e.g. profiles from `tools.wavelets.ring_profiles`
     :return: distance，float
     """
 
@@ -166,7 +259,10 @@ def calculate_distance(p, q, metric):
     if metric not in supported_metrics:
         raise NotImplementedError("{} metric is not implemented.".format(metric))
 
-    p, q = align_probablity_distribution(p, q)
+    if presorted:
+        p, q = align_sorted_distribution(p, q)
+    else:
+        p, q = align_probablity_distribution(p, q)
     if len(p) == 0 and len(q) == 0:
         return 0.0
 
@@ -187,8 +283,231 @@ def calculate_distance(p, q, metric):
         #p, q = align_probablity_distribution(p, q)
         if len(p) == 0 or len(q) == 0:
             return sum(p) + sum(q)
+        if presorted:
+            # sorted and of equal length, W1 is the mean absolute difference
+            return float(np.mean(np.abs(p - q)))
         return stats.wasserstein_distance(p, q)
     elif metric == 'hellinger':
         return hellinger_distance(p, q)
 
 
+def ring_negatives(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Number of negative values of every sorted ring, where `pad_sorted_rings` inserts zeros.
+    """
+    negative_prefix = np.concatenate([[0], np.cumsum(values < 0.0)])
+    return negative_prefix[offsets[1:]] - negative_prefix[offsets[:-1]]
+
+
+def pad_sorted_rings(values: np.ndarray, offsets: np.ndarray, rings: np.ndarray, widths: np.ndarray,
+                     width=None, negatives=None) -> np.ndarray:
+    """
+    Rings of a ragged profile structure as rows of a 2-D array, each aligned like `align_sorted_distribution`:
+    ring r gets widths[r] - len(r) zeros inserted before its non-negative values. Entries after widths[r] are 0.
+    :param values: sorted distributions, see `sorted_distributions` and `tools.wavelets.ring_profiles`
+    :param offsets: ring r is values[offsets[r]: offsets[r + 1]]
+    :param rings: rings to take, (b, )
+    :param widths: aligned length of every row, at least the ring length
+    :param width: number of columns, max(widths) by default
+    :param negatives: `ring_negatives` of all rings, computed if not given
+    :return: (b, width)
+    """
+    starts, ends = offsets[rings], offsets[rings + 1]
+    lengths = ends - starts
+    width = int(np.max(widths, initial=0)) if width is None else width
+    out = np.zeros((len(rings), width), dtype=np.float64)
+    negatives = ring_negatives(values, offsets) if negatives is None else negatives
+    n_negative = negatives[rings]
+    rows = np.repeat(np.arange(len(rings)), lengths)
+    ranks = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    columns = ranks + np.where(ranks >= n_negative[rows], (widths - lengths)[rows], 0)
+    out[rows, columns] = values[np.repeat(starts, lengths) + ranks]
+    return out
+
+
+def batch_distance(P: np.ndarray, Q: np.ndarray, metric, widths=None) -> np.ndarray:
+    """
+    calculate_distance of many pairs at once, rows of P and Q are aligned pairs (zero padded to the same length
+    and sorted, as by align_probablity_distribution or `pad_sorted_rings`).
+    Same results as the scalar functions, up to the order of floating point sums, and the same ValueError for
+    metrics that check for probability distributions.
+    :param P: (b, w)
+    :param Q: (b, w)
+    :param metric: str, see calculate_distance
+    :param widths: aligned length of every pair, entries after it are ignored, w by default
+    :return: distances, (b, )
+    """
+    if not metric or not isinstance(metric, str):
+        raise TypeError("Need to specify a metric.")
+    supported_metrics = ['l1', 'l2', 'kl', 'symmetric_kl', 'js', 'wasserstein_guass', 'wasserstein', 'hellinger']
+    metric = str.lower(metric)
+    if metric not in supported_metrics:
+        raise NotImplementedError("{} metric is not implemented.".format(metric))
+
+    P, Q = np.asarray(P, dtype=np.float64), np.asarray(Q, dtype=np.float64)
+    widths = np.full(len(P), P.shape[1]) if widths is None else np.asarray(widths)
+    mask = np.arange(P.shape[1])[None, :] < widths[:, None]
+
+    def total(x):
+        return np.sum(np.where(mask, x, 0.0), axis=1)
+
+    def check():
+        sums = np.concatenate([total(P), total(Q)])
+        nonempty = np.concatenate([widths, widths]) > 0
+        if np.any(~np.isclose(sums - 1.0, 0.0, rtol=0.0, atol=1e-4) & nonempty):
+            raise ValueError("The sum of probability distribution must be 1.0.")
+
+    def kl(p, q):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return total(p * np.log(p / q))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if metric == 'l1':
+            check()
+            dists = total(np.abs(P - Q))
+        elif metric == 'l2':
+            check()
+            dists = total(np.square(P - Q))
+        elif metric == 'kl':
+            check()
+            dists = kl(P, Q)
+        elif metric == 'symmetric_kl':
+            check()
+            dists = (kl(P, Q) + kl(Q, P)) / 2.0
+        elif metric == 'js':
+            check()
+            M = (P + Q) / 2.0
+            dists = (total(np.where(P > 0, P * np.log(P / M), 0.0))
+                     + total(np.where(Q > 0, Q * np.log(Q / M), 0.0))) / 2.0
+        elif metric == 'wasserstein_guass':
+            u1, u2 = total(P) / widths, total(Q) / widths
+            sigma1 = total(np.square(P - u1[:, None])) / widths
+            sigma2 = total(np.square(Q - u2[:, None])) / widths
+            dists = (u1 - u2) ** 2 + sigma1 + sigma2 - 2 * (sigma1 * sigma2) ** 0.5
+        elif metric == 'wasserstein':
+            dists = total(np.abs(P - Q)) / widths
+        else:
+            terms = np.sqrt(np.maximum(P * Q, 0.0))
+            BC = total(np.where((P < 0) | (Q < 0), 0.0, terms))
+            BC = np.where(np.isclose(BC, 0.0, rtol=0.0, atol=1e-6), 0.0, BC)
+            BC = np.where(np.isclose(BC, 1.0, rtol=0.0, atol=1e-6), 1.0, BC)
+            dists = np.sqrt(np.maximum(1.0 - BC, 0.0))
+    # two empty distributions
+    return np.where(widths > 0, dists, 0.0)
+
+
+def batch_ring_distance(values: np.ndarray, offsets: np.ndarray, rings_p: np.ndarray, rings_q: np.ndarray,
+                        metric, negatives=None) -> np.ndarray:
+    """
+    calculate_distance(p, q, metric, presorted=True) of ring pairs (rings_p[t], rings_q[t]) of a ragged profile
+    structure, see `pad_sorted_rings`.
+    :param negatives: `ring_negatives`, pass it when calling repeatedly on the same profiles
+    :return: (len(rings_p), )
+    """
+    negatives = ring_negatives(values, offsets) if negatives is None else negatives
+    widths = np.maximum(offsets[rings_p + 1] - offsets[rings_p], offsets[rings_q + 1] - offsets[rings_q])
+    width = int(np.max(widths, initial=0))
+    P = pad_sorted_rings(values, offsets, rings_p, widths, width, negatives)
+    Q = pad_sorted_rings(values, offsets, rings_q, widths, width, negatives)
+    return batch_distance(P, Q, metric, widths)
+
+
+def gauss_ring_moments(values: np.ndarray, offsets: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Moments of every ring for `wasserstein_guass_tile`: size, mean and scatter sum((x - mean)^2) of its values.
+    The moments of a zero padded ring follow from these without the padding, see `wasserstein_guass_tile`.
+    :return: sizes, means, scatters, each (n_rings, )
+    """
+    sizes = np.diff(offsets)
+    padded = np.append(values, 0.0)
+    sums = np.where(sizes > 0, np.add.reduceat(padded, offsets[:-1]), 0.0)
+    means = np.divide(sums, sizes, out=np.zeros(len(sizes)), where=sizes > 0)
+    deviations = np.append(values - np.repeat(means, sizes), 0.0)
+    scatters = np.where(sizes > 0, np.add.reduceat(np.square(deviations), offsets[:-1]), 0.0)
+    return sizes, means, scatters
+
+
+def wasserstein_guass_tile(moments_p, moments_q) -> np.ndarray:
+    """
+    calculate_distance(p, q, 'wasserstein_guass') of every ring p against every ring q, from `gauss_ring_moments`.
+    A ring of size l, sum s = l * c and scatter C padded with zeros to M = max(len(p), len(q)) has
+    mean u = s / M and variance (C + s * c * (1 - l / M)) / M, both terms non-negative, so tiny variances
+    don't cancel out as in E[x^2] - u^2. The distance (u1 - u2)^2 + s1 + s2 - 2 sqrt(s1 * s2) is evaluated as
+    (u1 - u2)^2 + (sqrt(s1) - sqrt(s2))^2, in place on the tile.
+    :param moments_p: (sizes, means, scatters) of the rows, each (b, )
+    :param moments_q: (sizes, means, scatters) of the columns, each (c, )
+    :return: (b, c) distances, 0 where both rings are empty
+    """
+    (sizes_p, means_p, scatters_p), (sizes_q, means_q, scatters_q) = moments_p, moments_q
+    sums_p, sums_q = sizes_p * means_p, sizes_q * means_q
+    inverse = np.maximum(sizes_p[:, None], sizes_q[None, :]).astype(np.float64)
+    np.maximum(inverse, 1.0, out=inverse)
+    np.reciprocal(inverse, out=inverse)
+
+    dists = sums_p[:, None] * inverse
+    other = sums_q[None, :] * inverse
+    dists -= other
+    np.square(dists, out=dists)
+
+    def padded_std(sizes, sums, means, scatters, out):
+        np.multiply(sizes, inverse, out=out)
+        np.subtract(1.0, out, out=out)
+        out *= sums * means
+        out += scatters
+        out *= inverse
+        return np.sqrt(out, out=out)
+
+    std_p = padded_std(sizes_p[:, None], sums_p[:, None], means_p[:, None], scatters_p[:, None],
+                       np.empty_like(inverse))
+    std_q = padded_std(sizes_q[None, :], sums_q[None, :], means_q[None, :], scatters_q[None, :], other)
+    std_p -= std_q
+    np.square(std_p, out=std_p)
+    dists += std_p
+    return dists
+
+
+def ring_quantiles(values: np.ndarray, offsets: np.ndarray, rings: np.ndarray, width: int, n_quantiles: int,
+                   negatives=None) -> (np.ndarray, np.ndarray):
+    """
+    Quantile vectors of rings zero padded to a common length, so that the L1 distance of two vectors
+    approximates W1 of the padded rings, mean|p - q| of the aligned arrays in calculate_distance.
+    The padded sorted ring (width values, zeros inserted as in `pad_sorted_rings`) is cut into n_quantiles
+    bins of equal mass, entry k is the bin mean / n_quantiles. Averaging within bins never increases
+    the distance, and a monotone quantile function deviates from its bin mean by at most (range of bin) / 2,
+    summed over bins (range of ring) / 2, so
+        L1(v_p, v_q) <= W1(p, q) <= L1(v_p, v_q) + error_p + error_q,  error = (max - min) / (2 * n_quantiles)
+    with max and min of the padded ring. With n_quantiles >= width every bin is one value and the L1 is exact.
+    :param values: sorted rings, see `pad_sorted_rings`
+    :param offsets: ring r is values[offsets[r]: offsets[r + 1]]
+    :param rings: rings to embed, (b, ), none longer than width
+    :param width: padded length
+    :param n_quantiles: number of bins, at most width are used
+    :param negatives: `ring_negatives` of all rings, computed if not given
+    :return: vectors (b, min(n_quantiles, width)) and errors (b, )
+    """
+    n_bins = min(n_quantiles, width)
+    if n_bins == 0:
+        return np.zeros((len(rings), 0)), np.zeros(len(rings))
+    negatives = ring_negatives(values, offsets) if negatives is None else negatives
+    starts, lengths = offsets[rings], offsets[rings + 1] - offsets[rings]
+    n_negative, n_zeros = negatives[rings][:, None], (width - lengths)[:, None]
+    # position of every bin edge in the padded ring, mapped to a position in the ring itself
+    edges = np.arange(n_bins + 1)[None, :] * (width / n_bins)
+    positions = np.minimum(edges, n_negative) + np.maximum(edges - n_negative - n_zeros, 0.0)
+    positions = np.minimum(positions, lengths[:, None])
+    # integral of the quantile step function of the ring up to each position
+    prefix = np.concatenate([[0.0], np.cumsum(values)])
+    whole = np.floor(positions).astype(np.int64)
+    index = starts[:, None] + whole
+    fraction = np.where(whole < lengths[:, None], positions - whole, 0.0)
+    integral = prefix[index] - prefix[starts][:, None] + fraction * np.append(values, 0.0)[index]
+    vectors = np.diff(integral, axis=1) / width
+
+    if n_bins == width:
+        return vectors, np.zeros(len(rings))
+    padded = lengths < width
+    first = np.where(lengths > 0, values[np.minimum(starts, len(values) - 1)], 0.0)
+    last = np.where(lengths > 0, values[np.maximum(starts + lengths - 1, 0)], 0.0)
+    highest = np.where(padded, np.maximum(last, 0.0), last)
+    lowest = np.where(padded, np.minimum(first, 0.0), first)
+    return vectors, (highest - lowest) / (2.0 * n_bins)
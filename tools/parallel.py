@@ -0,0 +1,285 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Shared-memory helpers and a persistent process pool.
+Read-only inputs and the output matrix are placed in multiprocessing.shared_memory (or a memmap file) once,
+workers attach them once per job, so that a task only carries a (start, end) row range.
+`Executor` keeps its worker processes across jobs and models, see `get_executor`.
+"""
+
+import atexit
+import multiprocessing
+import os
+import pickle
+import time
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArrays(object):
+
+    def __init__(self):
+        """
+        Owner of shared memory blocks, they are unlinked by close() or at the end of a with block.
+        """
+        self.blocks = []
+
+    def put(self, arr: np.ndarray) -> tuple:
+        """
+        Copy arr into a new shared memory block.
+        :return: spec to be passed to workers, see `attach`
+        """
+        arr = np.ascontiguousarray(arr)
+        spec, view = self.zeros(arr.shape, arr.dtype)
+        view[...] = arr
+        return spec
+
+    def zeros(self, shape, dtype) -> (tuple, np.ndarray):
+        """
+        New zero-filled shared array.
+        :return: spec for workers, and the owner's view, which must be dropped before close()
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.blocks.append(block)
+        view = np.ndarray(tuple(shape), dtype=dtype, buffer=block.buf)
+        view[...] = 0
+        return ("shm", block.name, tuple(shape), dtype.str), view
+
+    def put_object(self, obj) -> tuple:
+        """
+        Pickle obj into a new shared memory block, read back by `load_object`.
+        """
+        return self.put(np.frombuffer(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8))
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def memmap_spec(arr: np.memmap) -> tuple:
+    """
+    Spec of a memmap file, so that workers write into it directly.
+    """
+    arr.flush()
+    return "memmap", arr.filename, arr.shape, arr.dtype.str
+
+
+# shared memory blocks attached by this process, kept alive as long as the process
+_attached = []
+
+
+def attach(spec: tuple) -> np.ndarray:
+    """
+    Worker side view of an array described by a spec from `SharedArrays` or `memmap_spec`.
+    """
+    kind, name, shape, dtype = spec
+    if kind == "memmap":
+        return np.memmap(name, dtype=np.dtype(dtype), mode="r+", shape=tuple(shape))
+    block = shared_memory.SharedMemory(name=name)
+    _attached.append(block)
+    return np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def load_object(spec: tuple):
+    """
+    Worker side copy of an object stored by `SharedArrays.put_object`, the block is not kept attached.
+    """
+    _, name, shape, _ = spec
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return pickle.loads(bytes(block.buf[:shape[0]]))
+    finally:
+        block.close()
+
+
+def detach_all():
+    """
+    Close the blocks attached by this process, views of them must be dropped before.
+    """
+    while _attached:
+        block = _attached.pop()
+        try:
+            block.close()
+        except BufferError:
+            # still viewed somewhere, the mapping goes away with the last view
+            pass
+
+
+def triangle_row_blocks(n: int, n_blocks: int, row_costs=None) -> list:
+    """
+    Split rows of the upper triangle into contiguous blocks with about the same cost,
+    by default the number of pairs, row i has n - i - 1 pairs, so early blocks have fewer rows.
+    :param row_costs: cost of every row, (n, ), e.g. `triangle_row_costs`
+    :return: list of (start, end)
+    """
+    costs = np.arange(n - 1, -1, -1) if row_costs is None else np.asarray(row_costs, dtype=np.float64)
+    pairs = np.cumsum(costs)
+    total = pairs[-1] if n > 0 else 0
+    bounds = [0]
+    for k in range(1, n_blocks):
+        row = int(np.searchsorted(pairs, total * k / n_blocks)) + 1
+        if bounds[-1] < row < n:
+            bounds.append(row)
+    bounds.append(n)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+def triangle_row_costs(sizes: np.ndarray, pair_cost=1.0) -> np.ndarray:
+    """
+    Cost of every row of the upper triangle when a pair (i, j) costs pair_cost + sizes[i] + sizes[j],
+    e.g. sizes are the profile lengths of the nodes, which pairwise distances are linear in.
+    """
+    sizes = np.asarray(sizes, dtype=np.float64)
+    n = len(sizes)
+    later = np.cumsum(sizes[::-1])[::-1] - sizes
+    return np.arange(n - 1, -1, -1) * (pair_cost + sizes) + later
+
+
+class Executor(object):
+
+    def __init__(self, n_workers: int):
+        """
+        Process pool kept alive across jobs, so models called in loops don't fork a new pool every time.
+        A job is a function, a list of tasks and a context shared by all of its tasks: the context is pickled
+        into shared memory once and loaded by a worker when it takes its first task of the job.
+        Tasks are handed out one by one to whichever worker is idle, so split jobs into many tiles of
+        about equal cost (`triangle_row_blocks`) and no worker waits on a straggler.
+        After every job, stats hold the wall time, and busy time, tasks and utilization of every worker.
+        :param n_workers: number of worker processes
+        """
+        self.n_workers = n_workers
+        self.pool = None
+        self.stats = None
+
+    def start(self):
+        if self.pool is None:
+            # workers forked before the resource tracker runs would start their own,
+            # which then reports the shared memory they attached as leaked
+            resource_tracker.ensure_running()
+            # pid of the worker holding every rank, a worker respawned by the pool takes over a dead worker's rank
+            slots = multiprocessing.Array("i", self.n_workers)
+            self.pool = multiprocessing.Pool(self.n_workers, initializer=_init_executor_worker, initargs=(slots,))
+        return self
+
+    def imap(self, func, tasks, context=None):
+        """
+        Run func(context, task) for every task in the workers.
+        :param func: module level function, workers keep per-job state in `job_state`
+        :return: generator of (index of the task, result), in order of completion
+        """
+        self.start()
+        tasks = list(tasks)
+        busy = np.zeros(self.n_workers)
+        counts = np.zeros(self.n_workers, dtype=np.int64)
+        begin = time.perf_counter()
+        with SharedArrays() as shared:
+            spec = shared.put_object(context)
+            items = [(func, spec, index, task) for index, task in enumerate(tasks)]
+            for index, rank, cost, result in self.pool.imap_unordered(_run_task, items):
+                busy[rank] += cost
+                counts[rank] += 1
+                yield index, result
+        wall = time.perf_counter() - begin
+        self.stats = {"wall": wall, "tasks": len(tasks), "busy": busy, "counts": counts,
+                      "utilization": busy / max(wall, 1e-12),
+                      "imbalance": float(busy.max() / max(busy.mean(), 1e-12)) if len(tasks) else 1.0}
+
+    def map(self, func, tasks, context=None) -> list:
+        """
+        Results of `imap` in the order of tasks.
+        """
+        tasks = list(tasks)
+        results = [None] * len(tasks)
+        for index, result in self.imap(func, tasks, context):
+            results[index] = result
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+# executors shared by all models, by number of workers
+_executors = dict()
+
+
+def get_executor(n_workers: int) -> Executor:
+    """
+    The shared executor with n_workers processes, started on first use and closed at exit.
+    """
+    if n_workers not in _executors:
+        _executors[n_workers] = Executor(n_workers)
+    return _executors[n_workers]
+
+
+@atexit.register
+def _close_executors():
+    for executor in _executors.values():
+        executor.close()
+    _executors.clear()
+
+
+# rank, current job and its context and state in a worker process of an Executor
+_worker = {"rank": 0, "job": None, "context": None, "state": dict()}
+
+
+def _init_executor_worker(slots):
+    with slots.get_lock():
+        for rank, pid in enumerate(slots):
+            if pid == 0 or not _is_alive(pid):
+                slots[rank] = os.getpid()
+                _worker["rank"] = rank
+                return
+    raise RuntimeError("no free worker rank, every rank is held by a live process")
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def worker_rank() -> int:
+    """
+    Index of this worker in its Executor, in [0, n_workers), e.g. to pick a per-worker output.
+    """
+    return _worker["rank"]
+
+
+def job_state() -> dict:
+    """
+    Per-job state of this worker, e.g. arrays attached on the first task of a job,
+    cleared (and shared memory detached) when the worker takes a task of another job.
+    """
+    return _worker["state"]
+
+
+def _run_task(item):
+    func, spec, index, task = item
+    if _worker["job"] != spec:
+        _worker["state"].clear()
+        _worker["context"] = None
+        detach_all()
+        _worker["context"] = load_object(spec)
+        _worker["job"] = spec
+    start = time.perf_counter()
+    result = func(_worker["context"], task)
+    return index, _worker["rank"], time.perf_counter() - start, result
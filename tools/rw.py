@@ -9,6 +9,9 @@ import numpy as np
 import pandas as pd
 from configparser import ConfigParser
 
+from tools import condensed
+from tools import scratch
+
 
 def save_vectors(nodes: list, vectors: list, path: str):
     """
@@ -74,28 +77,33 @@ def save_results(res: dict, path):
 
 
 def save_distance_csv(path:str, nodes:list, mat):
+    # keep the float type of mat, float32 distances are written as float32
     node_int = [int(node) for node in nodes]
-    df = pd.DataFrame(data=mat, dtype=np.float, index=node_int, columns=node_int)
+    df = pd.DataFrame(data=np.asarray(mat), index=node_int, columns=node_int)
     df.sort_index(axis=1, inplace=True)
     df.sort_index(axis=0, inplace=True)
     df.to_csv(path, mode="w+", encoding="utf-8", index=True, header=True)
 
 
-def save_distance_edgelist(path: str, nodes: list, mat: np.ndarray):
+def save_distance_edgelist(path: str, nodes: list, mat: np.ndarray, block_rows=1024):
     """
     将距离矩阵以边的形式存入文件
     :param path: 路径
     :param nodes: 节点集
-    :param mat: 距离矩阵
+    :param mat: 距离矩阵, 可以是np.memmap, 也可以是压缩的上三角向量(见tools.condensed)
+    :param block_rows: 每次读入的行数
     :return:
     """
-    n = len(mat)
+    n = len(nodes)
     with open(path, mode="w+", encoding="utf-8") as fout:
-        for idx1, node1 in enumerate(nodes):
-            for idx2 in range(idx1 + 1, n):
-                node2 = nodes[idx2]
-                distance = mat[idx1, idx2]
-                fout.write(f"{node1} {node2} {distance}\n")
+        for start in range(0, n, block_rows):
+            for idx1 in range(start, min(start + block_rows, n)):
+                node1 = nodes[idx1]
+                row = np.asarray(condensed.upper_row(mat, idx1))
+                for offset, distance in enumerate(row):
+                    node2 = nodes[idx1 + 1 + offset]
+                    fout.write(f"{node1} {node2} {distance}\n")
+            scratch.drop_pages(mat)
 
 
 def save_edgelist(path: str, edgelist: list):
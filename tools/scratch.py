@@ -0,0 +1,93 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Out-of-core arrays for large graphs.
+Wavelet and distance matrices are backed by np.memmap files in a scratch directory,
+producers fill them and consumers read them in row blocks, so the resident memory
+is bounded by the working set instead of n^2.
+"""
+
+import mmap
+import os
+import tempfile
+
+import numpy as np
+
+
+def memmap_array(shape, dtype, scratch_dir: str, prefix="hsd-") -> np.memmap:
+    """
+    Zero-filled array backed by a new file in scratch_dir.
+    The file is kept until `release` is called, so that other processes can open it by name.
+    :param shape: array shape
+    :param dtype: float type
+    :param scratch_dir: directory of the backing file, created if missing
+    :param prefix: file name prefix
+    :return: np.memmap opened in w+ mode
+    """
+    os.makedirs(scratch_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=".dat", dir=scratch_dir)
+    os.close(fd)
+    return np.memmap(path, dtype=dtype, mode="w+", shape=tuple(shape))
+
+
+def open_memmap(path: str, shape, dtype, mode="r") -> np.memmap:
+    """
+    Open an existing backing file, e.g. one written by a worker process.
+    """
+    return np.memmap(path, dtype=dtype, mode=mode, shape=tuple(shape))
+
+
+def release(arr):
+    """
+    Flush and delete the backing file of a memmap, other arrays are left alone.
+    """
+    if isinstance(arr, np.memmap) and arr.filename is not None:
+        path = arr.filename
+        arr.flush()
+        del arr
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def drop_pages(arr):
+    """
+    Flush a memmap and drop its pages from this process, resident memory then only holds the current block.
+    Data stays in the file, later reads fault the pages back in. Other arrays are left alone.
+    """
+    if not isinstance(arr, np.memmap):
+        return
+    arr.flush()
+    # slices share the mmap object of the whole file
+    buffer = getattr(arr, "_mmap", None)
+    if buffer is not None and hasattr(mmap, "MADV_DONTNEED"):
+        buffer.madvise(mmap.MADV_DONTNEED)
+
+
+def rows_per_block(n_cols: int, dtype, working_set_bytes: int, n_buffers=1) -> int:
+    """
+    Number of rows per block so that n_buffers blocks of n_cols columns fit into the working set.
+    """
+    row_bytes = max(1, n_cols * np.dtype(dtype).itemsize * n_buffers)
+    return max(1, int(working_set_bytes // row_bytes))
+
+
+def iter_row_blocks(n_rows: int, block_rows: int):
+    """
+    (start, end) of consecutive row blocks.
+    """
+    for start in range(0, n_rows, block_rows):
+        yield start, min(start + block_rows, n_rows)
+
+
+def symmetrize_upper(mat, block_rows: int):
+    """
+    Copy the upper triangle of a square matrix onto the lower one, one row block at a time.
+    Producers only need to write contiguous row segments mat[i, i+1:], which keeps memmap writes sequential.
+    """
+    n = mat.shape[0]
+    for start, end in iter_row_blocks(n, block_rows):
+        mat[start:end, :start] = np.asarray(mat[:start, start:end]).T
+        diagonal = np.asarray(mat[start:end, start:end])
+        mat[start:end, start:end] = np.triu(diagonal) + np.triu(diagonal, 1).T
+        drop_pages(mat)
+    return mat
@@ -0,0 +1,110 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Persistent cache of laplacian eigen decompositions.
+Each graph is decomposed once per machine, the results are stored as .npy files
+under const.SpectralCacheDir and loaded back with memory mapping.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
+
+from tools import const
+
+
+def laplacian_hash(laplacian, nodes: list, kind="combinatorial") -> str:
+    """
+    Content hash of a laplacian, including the node order since it decides the rows of eigenvectors.
+    :param laplacian: sparse or dense laplacian
+    :param nodes: node order of the laplacian
+    :param kind: laplacian type, e.g. 'combinatorial' or 'normalized'
+    :return: hex digest
+    """
+    mat = sparse.csr_matrix(laplacian, dtype=float)
+    mat.sort_indices()
+    sha = hashlib.sha1()
+    sha.update(kind.encode("utf-8"))
+    sha.update("\t".join(str(node) for node in nodes).encode("utf-8"))
+    for arr in (mat.indptr, mat.indices, mat.data):
+        sha.update(np.ascontiguousarray(arr).tobytes())
+    return sha.hexdigest()
+
+
+def _save_array(path: str, arr: np.ndarray):
+    # write then rename, so that concurrent readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode="wb") as fout:
+        np.save(fout, arr)
+    os.replace(tmp_path, path)
+
+
+def cached_eigh(laplacian, nodes: list, kind="combinatorial", cache_dir=None) -> (np.ndarray, np.ndarray):
+    """
+    Full eigen decomposition of laplacian, computed once and then served from the cache.
+    :param laplacian: sparse or dense laplacian
+    :param nodes: node order of the laplacian
+    :param kind: laplacian type, part of the cache key
+    :param cache_dir: defaults to const.SpectralCacheDir
+    :return: eigenvalues, eigenvectors (read-only memory mapped float64 arrays)
+    """
+    cache_dir = const.SpectralCacheDir if cache_dir is None else cache_dir
+    key = laplacian_hash(laplacian, nodes, kind)
+    values_path = os.path.join(cache_dir, f"{key}.eigenvalues.npy")
+    vectors_path = os.path.join(cache_dir, f"{key}.eigenvectors.npy")
+
+    if os.path.exists(values_path) and os.path.exists(vectors_path):
+        eigenvalues, eigenvectors = np.load(values_path, mmap_mode="r"), np.load(vectors_path, mmap_mode="r")
+        # the key doesn't hold the dtype, entries decomposed in a lower precision are redone
+        if eigenvalues.dtype == np.float64 and eigenvectors.dtype == np.float64:
+            return eigenvalues, eigenvectors
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # always decomposed in float64, whatever the dtype of laplacian, models only cast the wavelet rows
+    dense = laplacian.toarray() if sparse.issparse(laplacian) else np.asarray(laplacian)
+    eigenvalues, eigenvectors = np.linalg.eigh(dense.astype(np.float64))
+    _save_array(vectors_path, eigenvectors)
+    _save_array(values_path, eigenvalues)
+    return np.load(values_path, mmap_mode="r"), np.load(vectors_path, mmap_mode="r")
+
+
+def cached_eigsh(laplacian, nodes: list, k: int, kind="combinatorial", cache_dir=None) -> (np.ndarray, np.ndarray):
+    """
+    The k smallest eigenpairs of a sparse laplacian, cached like `cached_eigh`.
+    :param laplacian: sparse laplacian
+    :param nodes: node order of the laplacian
+    :param k: number of eigenpairs
+    :param kind: laplacian type, part of the cache key
+    :param cache_dir: defaults to const.SpectralCacheDir
+    :return: eigenvalues (ascending), eigenvectors with shape (n, k)
+    """
+    cache_dir = const.SpectralCacheDir if cache_dir is None else cache_dir
+    key = f"{laplacian_hash(laplacian, nodes, kind)}.k{k}"
+    values_path = os.path.join(cache_dir, f"{key}.eigenvalues.npy")
+    vectors_path = os.path.join(cache_dir, f"{key}.eigenvectors.npy")
+
+    if not (os.path.exists(values_path) and os.path.exists(vectors_path)):
+        os.makedirs(cache_dir, exist_ok=True)
+        eigenvalues, eigenvectors = smallest_eigenpairs(laplacian, k)
+        _save_array(vectors_path, eigenvectors)
+        _save_array(values_path, eigenvalues)
+
+    return np.load(values_path, mmap_mode="r"), np.load(vectors_path, mmap_mode="r")
+
+
+def smallest_eigenpairs(laplacian, k: int) -> (np.ndarray, np.ndarray):
+    """
+    The k smallest eigenpairs of a sparse laplacian, by lanczos in shift-invert mode.
+    Laplacian is positive semi-definite, so a small negative shift keeps the factorization regular.
+    """
+    mat = sparse.csc_matrix(laplacian, dtype=float)
+    n = mat.shape[0]
+    if k >= n - 1:
+        eigenvalues, eigenvectors = np.linalg.eigh(mat.toarray())
+        return eigenvalues[:k], eigenvectors[:, :k]
+    eigenvalues, eigenvectors = splinalg.eigsh(mat, k=k, sigma=-1e-2, which="LM")
+    order = np.argsort(eigenvalues)
+    return eigenvalues[order], eigenvectors[:, order]
@@ -6,7 +6,9 @@ import networkx as nx
 import numpy as np
 from scipy import sparse
 
+from tools import condensed
 from tools import rw
+from tools import scratch
 
 def build_node_idx_map(graph) -> (dict, dict):
     """
@@ -97,9 +99,15 @@ def sparse_graph(graph: nx.Graph, threshold=None, percentile=None) -> nx.Graph:
     sparsed_graph.remove_edges_from(del_edges)
     return sparsed_graph
 
-def recommend_scale_range(eignvalues: list) -> (float, float):
+def recommend_scale_range(eignvalues: list, lmax=None) -> (float, float):
+    """
+    :param eignvalues: full spectrum, or the smallest part of it (see HSD.get_partial_spectrum)
+    :param lmax: largest eigenvalue, needed when eignvalues is a partial spectrum
+    """
     eignvalues = sorted(eignvalues)
     e1, en = eignvalues[0], eignvalues[-1]
+    if lmax is not None:
+        en = lmax
     for e in eignvalues:
         if e > 0.001:
             e1 = e
@@ -144,19 +152,42 @@ def filter_edgelist(edgelist: list, save_path: str, ratio=0.05) -> list:
     return edgelist
 
 
-def filter_distance_matrix(dist_mat: np.ndarray, nodes: list, save_path: str, ratio=0.05) -> list:
+def filter_distance_matrix(dist_mat: np.ndarray, nodes: list, save_path: str, ratio=0.05, block_rows=1024) -> list:
     # 对距离矩阵进行过滤，返回过滤后的边集
-    assert dist_mat.shape[0] == dist_mat.shape[1], "距离矩阵必须是方阵"
-    assert dist_mat.shape[0] == len(nodes), "距离矩阵的宽度必须和节点数量一致"
+    # 按行块读取距离矩阵(可以是np.memmap, 也可以是压缩的上三角向量)，只保留当前的前k大，不生成全部n^2/2条边
+    assert dist_mat.ndim == 1 or dist_mat.shape[0] == dist_mat.shape[1], "距离矩阵必须是方阵"
+    assert condensed.n_nodes(dist_mat) == len(nodes), "距离矩阵的宽度必须和节点数量一致"
+
+    n = len(nodes)
+
+    k = min(int(n * (n - 1) // 2 * ratio) + 1, n * (n - 1) // 2)
+    values, flat = np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+    for start in range(0, n, block_rows):
+        end = min(start + block_rows, n)
+        block_values, block_flat = condensed.upper_block(dist_mat, start, end)
+        values = np.concatenate([values, block_values])
+        flat = np.concatenate([flat, block_flat])
+        values, flat = _top_k(values, flat, k)
+        scratch.drop_pages(dist_mat)
+
+    # 与filter_edgelist一致: 距离降序，相同距离保持行优先顺序
+    order = np.lexsort((flat, -values))
+    edgelist = [(nodes[idx // n], nodes[idx % n], float(value)) for idx, value in zip(flat[order], values[order])]
+    if save_path is not None:
+        rw.save_edgelist(save_path, edgelist)
+    return edgelist
 
-    edgelist = []
-    for idx1, node1 in enumerate(nodes):
-        for idx2 in range(idx1 + 1, len(nodes)):
-            node2 = nodes[idx2]
-            distance = float(dist_mat[idx1, idx2])
-            edgelist.append((node1, node2, distance))
 
-    return filter_edgelist(edgelist, save_path, ratio)
+def _top_k(values: np.ndarray, flat: np.ndarray, k: int) -> (np.ndarray, np.ndarray):
+    # 前k大的值，相同值优先保留行优先序号小的
+    if len(values) <= k:
+        return values, flat
+    kth = np.partition(values, len(values) - k)[len(values) - k]
+    greater = np.flatnonzero(values > kth)
+    ties = np.flatnonzero(values == kth)
+    ties = ties[np.argsort(flat[ties], kind="stable")[:k - len(greater)]]
+    keep = np.concatenate([greater, ties])
+    return values[keep], flat[keep]
 
 
 # 将具有相同key的dict，取其value，放在列表的相同位置上对齐。
@@ -0,0 +1,466 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Heat wavelet backends working on the sparse laplacian directly, without pygsp.
+"""
+
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+from scipy import special
+from scipy.sparse import linalg as splinalg
+
+from tools import scratch
+from tools import util
+
+
+def estimate_lmax(laplacian) -> float:
+    """
+    Estimate the largest eigenvalue of laplacian, the same way as pygsp does:
+    a loose lanczos run, then enlarge it by 1 percent.
+    The lanczos run starts from a fixed vector, so the estimate of a graph is the same in every run,
+    it scales the chebyshev series and the scales of MultiHSD, which are part of checkpoint keys.
+    :param laplacian: sparse laplacian matrix
+    :return: upper bound of the spectrum
+    """
+    laplacian = sparse.csr_matrix(laplacian, dtype=float)
+    n = laplacian.shape[0]
+    if n <= 2:
+        lmax = np.max(np.linalg.eigvalsh(laplacian.toarray()))
+    else:
+        # not the constant vector, which is an eigenvector of eigenvalue 0
+        v0 = np.random.default_rng(0).uniform(0.5, 1.5, n)
+        try:
+            lmax = splinalg.eigsh(laplacian, k=1, tol=5e-3, ncv=min(n, 10), v0=v0, return_eigenvectors=False)[0]
+        except splinalg.ArpackNoConvergence:
+            # Gershgorin bound of combinatorial laplacian
+            lmax = 2.0 * np.max(laplacian.diagonal())
+    return float(lmax) * 1.01
+
+
+def chebyshev_coeffs(scale, lmax, order) -> np.ndarray:
+    """
+    Chebyshev coefficients of the heat kernel exp(-scale * x) on [0, lmax].
+    The first coefficient is already halved, as in `util.compute_chebshev_coeff_basis`.
+    :param scale: heat coefficient
+    :param lmax: upper bound of the spectrum
+    :param order: highest polynomial order
+    :return: order + 1 coefficients
+    """
+    # x = (y + 1) * lmax / 2 maps y in [-1, 1] onto [0, lmax]
+    coeffs = util.compute_chebshev_coeff_basis(scale * lmax / 2.0, order + 1)
+    return np.asarray(coeffs[:order + 1])
+
+
+def chebyshev_damping(order, kind=None) -> np.ndarray:
+    """
+    Damping factors g_k of a chebyshev series truncated at order, they suppress Gibbs oscillations.
+    :param order: highest polynomial order
+    :param kind: None (no damping), 'jackson' or 'lanczos' (sigma factors)
+    :return: order + 1 factors, g_0 = 1
+    """
+    k = np.arange(order + 1)
+    if kind is None:
+        return np.ones(order + 1)
+    elif kind == "jackson":
+        n_moments = order + 1
+        alpha = np.pi / (n_moments + 1)
+        return ((n_moments - k + 1) * np.cos(k * alpha) + np.sin(k * alpha) / np.tan(alpha)) / (n_moments + 1)
+    elif kind == "lanczos":
+        return np.sinc(k / (order + 1))
+    raise NotImplementedError(f"{kind} damping is not implemented.")
+
+
+def adaptive_chebyshev_coeffs(scale, lmax, tol, damping=None, max_order=1000) -> (np.ndarray, int, float, float):
+    """
+    Chebyshev coefficients of exp(-scale * x) on [0, lmax] with the lowest order whose truncation error is below tol.
+    With a = scale * lmax / 2, exp(-a(y + 1)) = e^-a I_0(a) + 2 sum_k (-1)^k e^-a I_k(a) T_k(y),
+    |T_k| <= 1 on the spectrum, so the sup error of the truncation at order m is bounded by sum_{k>m} |c_k|.
+    Damping changes the kept terms as well, by sum_{k<=m} |c_k| (1 - g_k), which only shrinks like 1 / m^2,
+    so it doesn't decide the order and is returned separately, the error of the damped series is bounded by the sum.
+    Every wavelet coefficient error is bounded by the same sup error.
+    :param scale: heat coefficient
+    :param lmax: upper bound of the spectrum
+    :param tol: target truncation error
+    :param damping: None, 'jackson' or 'lanczos', see `chebyshev_damping`
+    :param max_order: the order is never larger than this, with a warning if the truncation error then exceeds tol
+    :return: damped coefficients (order + 1 of them, the first one halved), order, truncation error, damping loss
+    """
+    a = scale * lmax / 2.0
+    k = np.arange(max_order + 2)
+    coeffs = 2.0 * np.where(k % 2 == 0, 1.0, -1.0) * special.ive(k, a)
+    coeffs[0] /= 2.0
+    # tails[m] = sum_{k>m} |c_k|
+    tails = np.cumsum(np.abs(coeffs)[::-1])[::-1][1:]
+
+    below = np.flatnonzero(tails[1:max_order + 1] <= tol)
+    if len(below) > 0:
+        order = int(below[0]) + 1
+    else:
+        order = max_order
+        warnings.warn(f"chebyshev order reached max_order={max_order} at scale {scale}, "
+                      f"truncation error {tails[order]:.3e} exceeds tol {tol:.3e}")
+    factors = chebyshev_damping(order, damping)
+    damping_loss = np.sum(np.abs(coeffs[:order + 1]) * (1.0 - factors))
+    return coeffs[:order + 1] * factors, order, float(tails[order]), float(damping_loss)
+
+
+class ChebyshevSeries(object):
+    """
+    Adaptive chebyshev series of the heat kernel at several scales on one spectrum bound,
+    each scale is expanded once by `adaptive_chebyshev_coeffs`.
+    """
+
+    def __init__(self, get_lmax, tol, damping=None):
+        """
+        :param get_lmax: function returning the upper bound of the spectrum, e.g. GraphOperator.get_lmax
+        :param tol: target truncation error
+        :param damping: None, 'jackson' or 'lanczos', see `chebyshev_damping`
+        """
+        self.get_lmax = get_lmax
+        self.tol = tol
+        self.damping = damping
+        self.coeffs = dict()
+        self.orders = dict()
+        # error bound of the damped series, the damping part of it is also in damping_losses
+        self.errors = dict()
+        self.damping_losses = dict()
+
+    def get(self, scale) -> np.ndarray:
+        """
+        Damped coefficients of scale, the first one halved.
+        """
+        if scale not in self.coeffs:
+            coeffs, order, error, loss = adaptive_chebyshev_coeffs(scale, self.get_lmax(), self.tol, self.damping)
+            self.coeffs[scale] = coeffs
+            self.orders[scale] = order
+            self.errors[scale] = error + loss
+            self.damping_losses[scale] = loss
+        return self.coeffs[scale]
+
+    def order(self, scale) -> int:
+        self.get(scale)
+        return self.orders[scale]
+
+
+def chebyshev_op(laplacian, coeffs, lmax, signals) -> np.ndarray:
+    """
+    Apply the chebyshev expansion of a filter on a block of signals, i.e.
+    sum_k c_k T_k(L) X, using sparse-matrix × dense-block products only.
+    :param laplacian: sparse laplacian, shape (n, n)
+    :param coeffs: chebyshev coefficients, coeffs[0] already halved
+    :param lmax: upper bound of the spectrum
+    :param signals: dense block, shape (n, b)
+    :return: filtered signals, shape (n, b)
+    """
+    a = lmax / 2.0
+    coeffs = np.asarray(coeffs, dtype=signals.dtype)
+    t_prev = signals
+    t_cur = (laplacian @ signals - a * signals) / a
+    result = coeffs[0] * t_prev + coeffs[1] * t_cur
+    for k in range(2, len(coeffs)):
+        t_next = 2.0 / a * (laplacian @ t_cur - a * t_cur) - t_prev
+        result += coeffs[k] * t_next
+        t_prev, t_cur = t_cur, t_next
+    return result
+
+
+def iter_impulse_blocks(n, block_size, rows=None):
+    """
+    Split the impulse columns into blocks, all nodes by default, or the given node indices.
+    """
+    rows = np.arange(n) if rows is None else np.asarray(rows, dtype=np.int64)
+    for start in range(0, len(rows), block_size):
+        yield rows[start:start + block_size]
+
+
+def impulses(n, cols, dtype=float) -> np.ndarray:
+    """
+    Dense block of impulses, column b is the indicator of node cols[b].
+    """
+    block = np.zeros((n, len(cols)), dtype=dtype)
+    block[cols, np.arange(len(cols))] = 1.0
+    return block
+
+
+def assemble_wavelets(row_block, n, block_size, eps, sparse_output=False, rows=None, dtype=float,
+                      out=None) -> np.ndarray:
+    """
+    Build the thresholded wavelet matrix block by block.
+    With sparse_output, only the current block is dense and the result is a CSR matrix,
+    so memory grows with the number of significant coefficients instead of n^2.
+    :param row_block: function, node indices -> dense wavelet rows with shape (len(rows), n)
+    :param n: number of nodes
+    :param block_size: number of rows per block
+    :param eps: coefficients not larger than eps are dropped
+    :param sparse_output: return scipy CSR matrix if True
+    :param rows: only compute these rows (node indices), in this order
+    :param dtype: float type of the wavelets
+    :param out: dense array to fill, e.g. a memmap from `tools.scratch.memmap_array`, its pages are dropped block by block
+    :return: wavelets, shape (n, n), or (len(rows), n)
+    """
+    n_rows = n if rows is None else len(rows)
+    if sparse_output:
+        blocks = [sparse.csr_matrix(threshold(row_block(cols), eps).astype(dtype, copy=False))
+                  for cols in iter_impulse_blocks(n, block_size, rows)]
+        wavelets = sparse.vstack(blocks, format="csr") if blocks else sparse.csr_matrix((0, n), dtype=dtype)
+        wavelets.sort_indices()
+        return wavelets
+
+    wavelets = np.empty((n_rows, n), dtype=dtype) if out is None else out
+    for start, cols in zip(range(0, n_rows, block_size), iter_impulse_blocks(n, block_size, rows)):
+        wavelets[start:start + len(cols), :] = threshold(row_block(cols), eps)
+        # write back the block, so that resident memory stays within a few blocks
+        scratch.drop_pages(wavelets)
+    return wavelets
+
+
+def row_values(wavelets, row, cols) -> np.ndarray:
+    """
+    wavelets[row, cols] as a 1-D array, for dense or CSR wavelets.
+    """
+    cols = np.asarray(cols, dtype=np.int64)
+    if not sparse.issparse(wavelets):
+        return np.asarray(wavelets[row, cols]).reshape(-1)
+
+    start, end = wavelets.indptr[row], wavelets.indptr[row + 1]
+    indices, data = wavelets.indices[start:end], wavelets.data[start:end]
+    values = np.zeros(len(cols), dtype=wavelets.dtype)
+    if len(indices) > 0 and len(cols) > 0:
+        pos = np.minimum(np.searchsorted(indices, cols), len(indices) - 1)
+        found = indices[pos] == cols
+        values[found] = data[pos[found]]
+    return values
+
+
+def ring_profiles(wavelets, members, offsets, n_layers) -> np.ndarray:
+    """
+    Sorted wavelet coefficients of every ring, the profile of ring r = i * n_layers + h is
+    values[offsets[r]: offsets[r + 1]], built from wavelets[i, members[offsets[r]: offsets[r + 1]]].
+    :param wavelets: dense, CSR or WaveletRows, row i belongs to the i-th node of the rings
+    :param members: see `tools.hierarchy.hierarchy_to_rings`
+    :param offsets: see `tools.hierarchy.hierarchy_to_rings`
+    :param n_layers: hop + 1
+    :return: values, aligned with members
+    """
+    n_rows = (len(offsets) - 1) // n_layers
+    values = np.empty(len(members), dtype=np.float64)
+    for i in range(n_rows):
+        start, end = offsets[i * n_layers], offsets[(i + 1) * n_layers]
+        values[start:end] = row_values(wavelets, i, members[start:end])
+    # sort inside each ring at once
+    ring_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return values[np.lexsort((values, ring_ids))]
+
+
+def ring_sums(responses, positions, members, offsets, n_layers) -> np.ndarray:
+    """
+    Sum the impulse responses over the rings of the impulse nodes.
+    :param responses: shape (n, b), column b is the response of the b-th impulse
+    :param positions: positions of the impulse nodes in the ring table, shape (b,)
+    :param members: ring members, see `hierarchy.hierarchy_to_rings`
+    :param offsets: ring offsets, see `hierarchy.hierarchy_to_rings`
+    :param n_layers: number of rings per node, i.e. hop + 1
+    :return: shape (b, n_layers)
+    """
+    rings = (np.asarray(positions, dtype=np.int64)[:, None] * n_layers + np.arange(n_layers)).reshape(-1)
+    starts, lengths = offsets[rings], offsets[rings + 1] - offsets[rings]
+    local_rings = np.repeat(np.arange(len(rings)), lengths)
+    entries = np.arange(np.sum(lengths)) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    sums = np.bincount(local_rings, weights=responses[members[entries], local_rings // n_layers],
+                       minlength=len(rings))
+    return sums.reshape((len(positions), n_layers))
+
+
+def chebyshev_ring_moments(laplacian, lmax, order, members, offsets, n_layers, block_size=256,
+                           rows=None, dtype=float) -> np.ndarray:
+    """
+    Run the chebyshev recurrence once and keep, for every node i and hop h, the ring sums
+        M[i, h, k] = sum_{j in ring(i, h)} T_k(L)[j, i]
+    Only the chebyshev coefficients depend on the scale, so the ring sums of the heat wavelets
+    at any scale are M @ chebyshev_coeffs(scale, lmax, order).
+    Note that the small coefficients are not thresholded in this space.
+    :param laplacian: sparse laplacian
+    :param lmax: upper bound of the spectrum
+    :param order: chebyshev order
+    :param members: ring members, see `hierarchy.hierarchy_to_rings`, built in the order of rows
+    :param offsets: ring offsets, see `hierarchy.hierarchy_to_rings`, built in the order of rows
+    :param n_layers: number of rings per node, i.e. hop + 1
+    :param block_size: number of impulse columns per recurrence
+    :param rows: only compute the moments of these nodes (indices)
+    :param dtype: float type of the recurrence
+    :return: moments, shape (n, n_layers, order + 1), or (len(rows), n_layers, order + 1)
+    """
+    laplacian = sparse.csr_matrix(laplacian, dtype=dtype)
+    n = laplacian.shape[0]
+    n_rows = n if rows is None else len(rows)
+    moments = np.zeros((n_rows, n_layers, order + 1), dtype=dtype)
+    a = lmax / 2.0
+    for start, cols in zip(range(0, n_rows, block_size), iter_impulse_blocks(n, block_size, rows)):
+        block = np.arange(start, start + len(cols))
+        t_prev = impulses(n, cols, dtype)
+        t_cur = (laplacian @ t_prev - a * t_prev) / a
+        moments[block, :, 0] = ring_sums(t_prev, block, members, offsets, n_layers)
+        if order >= 1:
+            moments[block, :, 1] = ring_sums(t_cur, block, members, offsets, n_layers)
+        for k in range(2, order + 1):
+            t_next = 2.0 / a * (laplacian @ t_cur - a * t_cur) - t_prev
+            moments[block, :, k] = ring_sums(t_next, block, members, offsets, n_layers)
+            t_prev, t_cur = t_cur, t_next
+    return moments
+
+
+def heat_kernel_rows(eigenvalues, eigenvectors, scale, rows, dtype=float) -> np.ndarray:
+    """
+    Rows of the heat kernel U exp(-scale * Λ) U^T, from a full or a partial spectrum.
+    """
+    # computed in the precision of the spectrum, only the block is cast
+    eigenvectors = np.asarray(eigenvectors)
+    block = np.dot(eigenvectors[rows] * np.exp(-scale * np.asarray(eigenvalues)), np.transpose(eigenvectors))
+    return block.astype(dtype, copy=False)
+
+
+def truncation_error(eigenvalues, scale) -> float:
+    """
+    Error bound of `heat_kernel_rows` on a partial spectrum: the dropped eigenvalues are all >= the largest kept one,
+    so both the spectral norm and every entry of the error are at most exp(-scale * λ_k).
+    """
+    return float(np.exp(-scale * np.max(eigenvalues)))
+
+
+def expm_rows(laplacian, scale, rows, dtype=float) -> np.ndarray:
+    """
+    Heat wavelets of the given rows by krylov expm_multiply, exp(-scale * L) applied to their impulses.
+    The precision is scipy's, i.e. double unit roundoff, no chebyshev order or lmax is involved.
+    """
+    signals = impulses(laplacian.shape[0], rows, dtype)
+    return splinalg.expm_multiply(-scale * laplacian, signals).astype(dtype, copy=False).T
+
+
+def expm_scale_grid(laplacian, scales, signals) -> np.ndarray:
+    """
+    exp(-s * L) X for every s in scales, in one sweep: the block is propagated from one scale
+    to the next, exp(-s2 L) X = exp(-(s2 - s1) L) exp(-s1 L) X, so each step only pays for the increment.
+    :param laplacian: sparse laplacian
+    :param scales: scale grid
+    :param signals: dense block, shape (n, b)
+    :return: shape (n_scales, n, b)
+    """
+    laplacian = sparse.csr_matrix(laplacian, dtype=signals.dtype)
+    scales = np.asarray(scales, dtype=float)
+    order = np.argsort(scales)
+    sorted_scales = scales[order]
+    responses = np.empty((len(scales),) + signals.shape, dtype=signals.dtype)
+    responses[order[0]] = splinalg.expm_multiply(-sorted_scales[0] * laplacian, signals)
+    for idx in range(1, len(scales)):
+        step = sorted_scales[idx] - sorted_scales[idx - 1]
+        responses[order[idx]] = splinalg.expm_multiply(-step * laplacian, responses[order[idx - 1]])
+    return responses
+
+
+def threshold(wavelets, eps) -> np.ndarray:
+    """
+    Drop the wavelet coefficients not larger than eps.
+    """
+    return np.where(wavelets > eps, wavelets, 0.0)
+
+
+class WaveletRows(object):
+    """
+    Wavelet matrix whose rows are computed on demand, one block at a time, and kept in a LRU cache
+    bounded by max_bytes. Supports the indexing used on materialized wavelets:
+    wavelets[i] and wavelets[i, cols].
+    """
+
+    def __init__(self, row_block, n, block_size=256, eps=0.0, max_bytes=1 << 30, rows=None, sparse_blocks=False,
+                 dtype=float):
+        """
+        :param row_block: function, node indices -> dense wavelet rows (unthresholded) with shape (len(rows), n)
+        :param n: number of nodes
+        :param block_size: number of rows computed together
+        :param eps: coefficients not larger than eps are dropped
+        :param max_bytes: budget of the cached blocks, the most recent block is always kept
+        :param rows: node indices behind the rows of this matrix, all nodes by default
+        :param sparse_blocks: cache blocks as CSR matrices
+        :param dtype: float type of the wavelets
+        """
+        self.row_block = row_block
+        self.rows = None if rows is None else np.asarray(rows, dtype=np.int64)
+        self.shape = (n if rows is None else len(rows), n)
+        self.block_size = block_size
+        self.eps = eps
+        self.max_bytes = max_bytes
+        self.sparse_blocks = sparse_blocks
+        self.dtype = dtype
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.hits, self.misses = 0, 0
+
+    def __getstate__(self):
+        # blocks are cheaper to recompute than to pickle into worker processes
+        state = self.__dict__.copy()
+        state["cache"], state["cached_bytes"] = OrderedDict(), 0
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            row, cols = key
+            return self.row(row)[cols]
+        return self.row(key)
+
+    def row(self, idx) -> np.ndarray:
+        """
+        Dense row idx.
+        """
+        idx = int(idx)
+        if idx < 0:
+            idx += self.shape[0]
+        block = self._get_block(idx // self.block_size)
+        offset = idx % self.block_size
+        if self.sparse_blocks:
+            return block[offset].toarray().reshape(-1)
+        return block[offset]
+
+    def _get_block(self, block_id):
+        if block_id in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(block_id)
+            return self.cache[block_id]
+
+        self.misses += 1
+        start = block_id * self.block_size
+        positions = np.arange(start, min(start + self.block_size, self.shape[0]))
+        block = threshold(self.row_block(positions if self.rows is None else self.rows[positions]), self.eps)
+        block = block.astype(self.dtype, copy=False)
+        if self.sparse_blocks:
+            block = sparse.csr_matrix(block)
+
+        self.cache[block_id] = block
+        self.cached_bytes += _block_bytes(block)
+        while self.cached_bytes > self.max_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= _block_bytes(evicted)
+        return block
+
+    def stats(self) -> dict:
+        """
+        Hit and miss statistics of the row cache, counted per row access.
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+                "cached_blocks": len(self.cache),
+                "cached_bytes": self.cached_bytes,
+                }
+
+
+def _block_bytes(block) -> int:
+    if sparse.issparse(block):
+        return block.data.nbytes + block.indices.nbytes + block.indptr.nbytes
+    return block.nbytes